@@ -0,0 +1,94 @@
+# bench_serialization.py (Response size and serialization time of /search payloads for top_k 5..100)
+#
+# Usage: python bench_serialization.py
+# Uses training/hadiths.json when present, otherwise synthetic hadiths of typical length.
+
+import os
+import gzip
+import json
+import time
+import random
+from typing import Dict, List, Optional
+from pydantic import BaseModel
+from fastapi.encoders import jsonable_encoder
+from serialization import dumps, project_result, orjson
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+HADITHS_JSON_PATH = os.path.join(BASE_DIR, "..", "training", "hadiths.json")
+TOP_K_VALUES = [5, 10, 25, 50, 100]
+REPEATS = 200
+SNIPPET_CHARS = 160
+LIST_FIELDS = ["id", "collectionId", "idInBook", "chapterName", "english"] # What a result list renders
+
+# Same shape as main.SearchResult (not imported, so the benchmark doesn't load the index)
+class SearchResult(BaseModel):
+    id: int
+    idInBook: Optional[int] = None
+    chapterId: Optional[int] = None
+    chapterName: Optional[str] = None
+    bookId: Optional[int] = None
+    arabic: Optional[str] = None
+    english: Optional[Dict] = None
+    title: Optional[str] = None
+    collectionId: Optional[str] = None
+    retrieval_score: float
+
+class SearchResponse(BaseModel):
+    results: List[SearchResult]
+
+def load_sample_hadiths(n):
+    if os.path.exists(HADITHS_JSON_PATH):
+        with open(HADITHS_JSON_PATH, 'r', encoding='utf-8') as f:
+            hadiths = json.load(f)
+        return random.Random(42).sample(hadiths, min(n, len(hadiths)))
+    words_ar = ["حدثنا", "عن", "قال", "رسول", "الله", "صلى", "عليه", "وسلم", "الصلاة", "الناس"]
+    words_en = ["the", "Prophet", "said", "narrated", "Allah", "prayer", "people", "whoever", "messenger", "and"]
+    rng = random.Random(42)
+    return [{
+        "id": i, "idInBook": i, "chapterId": 1, "bookId": 1, "title": "Sahih al-Bukhari",
+        "arabic": " ".join(rng.choice(words_ar) for _ in range(120)),
+        "english": {"narrator": "Narrated Abu Huraira:", "text": " ".join(rng.choice(words_en) for _ in range(160))},
+    } for i in range(n)]
+
+def time_it(fn):
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        body = fn()
+    return (time.perf_counter() - start) / REPEATS * 1000, body
+
+def bench(hadiths, top_k):
+    rows = [{**h, "collectionId": "bukhari", "chapterName": "Revelation", "retrieval_score": 0.5} for h in hadiths[:top_k]]
+    cached = [SearchResult(**row).model_dump() for row in rows]
+
+    def standard():
+        # Per-hit validation, response_model re-validation, jsonable_encoder + json.dumps (FastAPI default path)
+        response = SearchResponse(results=[SearchResult(**row) for row in rows])
+        validated = SearchResponse.model_validate(response.model_dump())
+        return json.dumps(jsonable_encoder(validated), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def fast_full():
+        return dumps({"results": [{**r, "retrieval_score": 0.5} for r in cached]})
+
+    def fast_projected():
+        return dumps({"results": [project_result({**r, "retrieval_score": 0.5}, LIST_FIELDS, SNIPPET_CHARS) for r in cached]})
+
+    report = []
+    for name, fn in [("standard", standard), ("fast", fast_full), ("fast+snippet", fast_projected)]:
+        ms, body = time_it(fn)
+        sizes = f"{len(body):>8} B raw {len(gzip.compress(body)):>7} B gzip"
+        if brotli is not None:
+            sizes += f" {len(brotli.compress(body)):>7} B br"
+        report.append(f"top_k={top_k:<4} {name:<13} {ms:8.3f} ms  {sizes}")
+    return report
+
+if __name__ == "__main__":
+    sample = load_sample_hadiths(max(TOP_K_VALUES))
+    print(f"Serialization benchmark ({REPEATS} repeats, encoder: {'orjson' if orjson else 'stdlib json'})")
+    for top_k in TOP_K_VALUES:
+        for line in bench(sample, top_k):
+            print(line)
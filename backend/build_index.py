@@ -1,6 +1,7 @@
 # build_index.py (Using OpenAI text-embedding-3-small with Recursive Splitter)
 
 import os
+import sys
 import json
 import re
 import numpy as np
@@ -9,9 +10,14 @@ from openai import OpenAI
 from tqdm import tqdm
 import logging
 import time
+import hashlib
 from dotenv import load_dotenv
 import tiktoken # <--- Import tiktoken
 from langchain_text_splitters import RecursiveCharacterTextSplitter # <--- Import Langchain Splitter
+from dedup import find_duplicate_clusters
+from shards import write_shards
+from profiling import BuildProfiler
+from two_stage import COMPACT_DIM, COMPACT_QUANTIZATION, build_compact_index, save_full_vectors, load_full_vectors, compare_recall
 
 load_dotenv()
 
@@ -26,6 +32,18 @@ TRAINING_DIR = os.path.join(BASE_DIR, "..", "training")
 INPUT_JSON_PATH = os.path.join(TRAINING_DIR, "hadiths.json")
 OUTPUT_INDEX_PATH = os.path.join(BASE_DIR, "hadith_index_openai_small_recursive.faiss") # <-- New index name
 OUTPUT_MAPPING_PATH = os.path.join(BASE_DIR, "index_mapping_openai_small_recursive.json") # <-- New mapping name
+OUTPUT_INDEX_VERSION_PATH = os.path.join(BASE_DIR, "index_version.json") # Invalidates artifacts built for other indexes
+OUTPUT_COMPACT_INDEX_PATH = os.path.join(BASE_DIR, f"hadith_index_openai_small_recursive_{COMPACT_DIM}d.faiss") # First-stage index
+OUTPUT_FULL_VECTORS_PATH = os.path.join(BASE_DIR, "hadith_vectors_openai_small_recursive_f16.npy") # Full vectors for rescoring
+# Optional sharding for the scatter-gather search mode (NUM_SHARDS=0 disables)
+NUM_SHARDS = int(os.environ.get("NUM_SHARDS", "0"))
+SHARD_BY = os.environ.get("SHARD_BY", "hash") # "hash" (parent hadith id) or "collection" (one shard per collection)
+OUTPUT_SHARDS_DIR = os.path.join(BASE_DIR, "shards")
+RECALL_CHECK_SAMPLES = 1000 # Pseudo-queries used for the recall comparison when no held-out set exists
+EVAL_QUERIES_PATH = os.path.join(TRAINING_DIR, "eval_queries.json") # Held-out queries exported by train_hadith_model.py
+
+sys.path.insert(0, TRAINING_DIR)
+from fast_ir_evaluator import evaluate_faiss_index, load_query_set # noqa: E402
 
 OPENAI_MODEL = "text-embedding-3-small"
 EMBEDDING_DIM = 1536
@@ -34,6 +52,10 @@ TARGET_CHUNK_TOKENS = 256  # Target size in tokens (adjust as needed)
 CHUNK_OVERLAP_TOKENS = 50  # Overlap in tokens (adjust as needed)
 API_BATCH_SIZE = 200 # Batch size for OpenAI API
 DELAY_BETWEEN_BATCHES = 1 # Seconds delay
+PROFILE_OUTPUT_PATH = os.environ.get("PROFILE_BUILD") # Set to a file path to write a folded sampling profile of the build
+# Near-duplicate collapsing: one vector per cluster of (near-)identical chunks
+DEDUP_CHUNKS = True
+DEDUP_NEAR_DUPLICATES = True # False = exact (normalized-text hash) duplicates only
 
 # --- Tiktoken Length Function ---
 def tiktoken_len(text):
@@ -85,6 +107,9 @@ def standardize_collection(title: str) -> str:
     return mapping.get(normalized_title, normalized_title)
 
 
+# --- Build Profiling (stage timings; sampling profile when PROFILE_BUILD is set) ---
+build_profiler = BuildProfiler(PROFILE_OUTPUT_PATH)
+
 # --- Initialize OpenAI Client ---
 # (Keep OpenAI client initialization as before)
 logging.info("Initializing OpenAI client...")
@@ -94,6 +119,7 @@ if not api_key:
 client = OpenAI(api_key=api_key)
 logging.info(f"Using OpenAI model: {OPENAI_MODEL} with dimension {EMBEDDING_DIM}")
 
+build_profiler.lap("init_client")
 
 # --- Load Data ---
 # (Keep data loading as before)
@@ -103,6 +129,8 @@ if not os.path.exists(INPUT_JSON_PATH):
 with open(INPUT_JSON_PATH, 'r', encoding='utf-8') as f:
     all_hadiths = json.load(f)
 
+build_profiler.lap("load_data")
+
 # --- Prepare Chunks and Mapping using Recursive Splitter ---
 chunks_to_embed = []
 mapping_data = []
@@ -150,6 +178,34 @@ for hadith in tqdm(all_hadiths):
 
 logging.info(f"Prepared {len(chunks_to_embed)} text chunks for embedding.")
 
+build_profiler.lap("chunking")
+
+# --- Collapse Exact and Near-Duplicate Chunks ---
+# Parallel narrations across collections produce (near-)identical chunks. Each cluster is
+# embedded once; its vector keeps the list of every parent hadith it stands for.
+if DEDUP_CHUNKS:
+    clusters = find_duplicate_clusters(chunks_to_embed, near_duplicates=DEDUP_NEAR_DUPLICATES)
+else:
+    clusters = [[i] for i in range(len(chunks_to_embed))]
+
+total_chunks = len(chunks_to_embed)
+deduped_chunks = []
+deduped_mapping = []
+for vector_index, members in enumerate(clusters):
+    representative = mapping_data[members[0]]
+    parent_ids = []
+    for member in members:
+        parent_id = mapping_data[member]["parent_hadith_id"]
+        if parent_id not in parent_ids:
+            parent_ids.append(parent_id)
+    deduped_chunks.append(chunks_to_embed[members[0]])
+    deduped_mapping.append({**representative, "vector_index": vector_index, "parent_hadith_ids": parent_ids})
+chunks_to_embed, mapping_data = deduped_chunks, deduped_mapping
+compression_ratio = total_chunks / max(len(chunks_to_embed), 1)
+logging.info(f"Dedup: {total_chunks} chunks -> {len(chunks_to_embed)} vectors (compression ratio {compression_ratio:.2f}x).")
+
+build_profiler.lap("dedup")
+
 # --- Compute Embeddings for Chunks ---
 # (Embedding computation loop remains the same as previous version)
 all_embeddings = []
@@ -181,23 +237,91 @@ logging.info(f"Embeddings computed. Array shape: {all_embeddings_np.shape}")
 logging.info("Normalizing embeddings (L2 normalization)...")
 faiss.normalize_L2(all_embeddings_np)
 
+build_profiler.lap("embedding")
+
 # --- Build the FAISS Index for Chunks ---
 logging.info(f"Creating FAISS index (IndexFlatIP) with dimension {EMBEDDING_DIM}...")
 index = faiss.IndexFlatIP(EMBEDDING_DIM)
 index.add(all_embeddings_np)
 logging.info(f"FAISS index created; total chunk vectors indexed: {index.ntotal}")
 
+build_profiler.lap("build_index")
+
 # --- Save the FAISS Index and the New Mapping ---
 logging.info(f"Saving FAISS index to {OUTPUT_INDEX_PATH}")
 faiss.write_index(index, OUTPUT_INDEX_PATH)
 
+build_profiler.lap("save_index")
+
+# --- Compact First-Stage Index + float16 Full Vectors (two-stage retrieval) ---
+logging.info(f"Creating compact first-stage index ({COMPACT_DIM}d, {COMPACT_QUANTIZATION})...")
+compact_index = build_compact_index(all_embeddings_np)
+logging.info(f"Saving compact index to {OUTPUT_COMPACT_INDEX_PATH}")
+faiss.write_index(compact_index, OUTPUT_COMPACT_INDEX_PATH)
+logging.info(f"Saving float16 full vectors to {OUTPUT_FULL_VECTORS_PATH}")
+save_full_vectors(OUTPUT_FULL_VECTORS_PATH, all_embeddings_np)
+full_bytes = all_embeddings_np.nbytes
+compact_bytes = os.path.getsize(OUTPUT_COMPACT_INDEX_PATH)
+logging.info(f"Resident index size: {full_bytes / 1e6:.1f} MB full float32 vs {compact_bytes / 1e6:.1f} MB compact ({full_bytes / max(compact_bytes, 1):.1f}x smaller)")
+
 logging.info(f"Saving mapping to {OUTPUT_MAPPING_PATH}")
 final_mapping = {item['vector_index']: {
                     'parent_hadith_id': item['parent_hadith_id'],
                     'chunk_index': item['chunk_index'],
-                    'collection': item['collection']
+                    'collection': item['collection'],
+                    'parent_hadith_ids': item['parent_hadith_ids'] # All hadiths sharing this vector (representative first)
                  } for item in mapping_data}
 with open(OUTPUT_MAPPING_PATH, 'w', encoding='utf-8') as f:
     json.dump(final_mapping, f, ensure_ascii=False, indent=2)
 
+build_profiler.lap("compact_index_and_mapping")
+
+# --- Record the Index Version (content hash of vectors + mapping) ---
+index_version = hashlib.sha1(all_embeddings_np.tobytes() + json.dumps(final_mapping, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+with open(OUTPUT_INDEX_VERSION_PATH, 'w', encoding='utf-8') as f:
+    json.dump({"version": index_version, "model": OPENAI_MODEL, "vectors": int(index.ntotal), "built_at": time.strftime('%Y-%m-%dT%H:%M:%S')}, f, indent=2)
+logging.info(f"Index version {index_version} written to {OUTPUT_INDEX_VERSION_PATH}")
+
+build_profiler.lap("index_version")
+
+# --- Optional: Write Index Shards + Manifest ---
+if NUM_SHARDS > 0:
+    logging.info(f"Writing {NUM_SHARDS if SHARD_BY == 'hash' else 'per-collection'} shards (by {SHARD_BY}) to {OUTPUT_SHARDS_DIR}")
+    write_shards(all_embeddings_np, final_mapping, OUTPUT_SHARDS_DIR, shard_by=SHARD_BY, num_shards=NUM_SHARDS)
+
+build_profiler.lap("shards")
+
+# --- Score the New Index on the Held-out Query Set ---
+eval_embeddings_np = None
+if os.path.exists(EVAL_QUERIES_PATH):
+    logging.info(f"Evaluating index against held-out queries from {EVAL_QUERIES_PATH}")
+    eval_queries, eval_relevant_docs = load_query_set(EVAL_QUERIES_PATH)
+    eval_query_ids = list(eval_queries.keys())
+    eval_query_texts = [normalize_arabic_text(eval_queries[qid]) for qid in eval_query_ids]
+    eval_embeddings = []
+    for i in tqdm(range(0, len(eval_query_texts), API_BATCH_SIZE), desc="Embedding eval queries"):
+        response = client.embeddings.create(input=eval_query_texts[i:i+API_BATCH_SIZE], model=OPENAI_MODEL)
+        eval_embeddings.extend(item.embedding for item in response.data)
+    eval_embeddings_np = np.array(eval_embeddings, dtype=np.float32)
+    faiss.normalize_L2(eval_embeddings_np)
+    evaluate_faiss_index(index, final_mapping, eval_embeddings_np, eval_query_ids, eval_relevant_docs)
+else:
+    logging.info(f"No held-out query set at {EVAL_QUERIES_PATH}; skipping index evaluation.")
+
+build_profiler.lap("evaluation")
+
+# --- Recall of Two-Stage Retrieval vs Exact Full-Dimension Search ---
+if eval_embeddings_np is not None:
+    recall_queries = eval_embeddings_np
+else:
+    # Chunk vectors stand in for queries; only agreement with exact search is measured
+    sample_rows = np.random.RandomState(42).choice(len(all_embeddings_np), min(RECALL_CHECK_SAMPLES, len(all_embeddings_np)), replace=False)
+    recall_queries = all_embeddings_np[sample_rows]
+# Rescore from the float16 mmap'd file, exactly as RETRIEVAL_MODE=two_stage serves it
+recall = compare_recall(index, compact_index, load_full_vectors(OUTPUT_FULL_VECTORS_PATH), recall_queries, k=10)
+logging.info(f"Recall@10 vs exact search: compact only {recall['first_stage_recall']:.4f}, two-stage {recall['two_stage_recall']:.4f}")
+
+build_profiler.lap("recall_check")
+build_profiler.finish()
+
 logging.info("Index building complete.")
\ No newline at end of file
@@ -0,0 +1,123 @@
+# build_related.py (Precomputes "related hadiths" from the build_index.py artifacts into SQLite)
+
+import os
+import sys
+import json
+import sqlite3
+import logging
+import time
+import numpy as np
+import faiss
+from tqdm import tqdm
+
+# --- Logging Setup ---
+logging.basicConfig(format='%(asctime)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S',
+                    level=logging.INFO)
+
+# --- Configuration ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TRAINING_DIR = os.path.join(BASE_DIR, "..", "training")
+ASSETS_DIR = os.path.join(BASE_DIR, "..", "assets")
+INDEX_PATH = os.path.join(BASE_DIR, "hadith_index_openai_small_recursive.faiss")
+MAPPING_PATH = os.path.join(BASE_DIR, "index_mapping_openai_small_recursive.json")
+HADITHS_JSON_PATH = os.path.join(TRAINING_DIR, "hadiths.json")
+DB_PATH = os.path.abspath(os.path.join(ASSETS_DIR, "database", "hadith_data.db"))
+
+NUM_RELATED = 10 # Neighbours stored per hadith (MAX_RELATED in main.py caps /related?limit= at this)
+QUERY_BLOCK_SIZE = 2048 # Parent vectors searched per FAISS call
+NUM_THREADS = os.cpu_count() or 1
+
+sys.path.insert(0, TRAINING_DIR)
+from fast_ir_evaluator import blocked_search # noqa: E402
+from main import standardize_collection # noqa: E402 -- the collection ids /related and /search return
+
+# --- Aggregate Chunk Vectors to Parent Hadiths ---
+def load_chunk_vectors():
+    """Reads every chunk vector back out of the built index."""
+    logging.info(f"Loading FAISS index from: {INDEX_PATH}")
+    index = faiss.read_index(INDEX_PATH)
+    return index.reconstruct_n(0, index.ntotal)
+
+def aggregate_parent_vectors(chunk_vectors, mapping):
+    """Mean-pools chunk vectors per parent hadith (a shared vector counts for every sibling) and renormalizes."""
+    parent_rows = {}
+    for vector_idx_str, metadata in mapping.items():
+        for parent_id in metadata.get("parent_hadith_ids") or [metadata.get("parent_hadith_id")]:
+            parent_rows.setdefault(int(parent_id), []).append(int(vector_idx_str))
+
+    parent_ids = np.array(sorted(parent_rows), dtype=np.int64)
+    parent_vectors = np.zeros((len(parent_ids), chunk_vectors.shape[1]), dtype=np.float32)
+    for row, parent_id in enumerate(tqdm(parent_ids, desc="Aggregating chunks")):
+        parent_vectors[row] = chunk_vectors[parent_rows[int(parent_id)]].mean(axis=0)
+    faiss.normalize_L2(parent_vectors)
+    return parent_ids, parent_vectors
+
+# --- Blocked kNN over the Whole Corpus ---
+def compute_related(parent_ids, parent_vectors, num_related=NUM_RELATED):
+    """Returns (scores, neighbour_ids) of the top-N other hadiths for every parent."""
+    faiss.omp_set_num_threads(NUM_THREADS)
+    logging.info(f"Running blocked kNN for {len(parent_ids)} hadiths on {NUM_THREADS} threads...")
+    parent_index = faiss.IndexFlatIP(parent_vectors.shape[1])
+    parent_index.add(parent_vectors)
+    k = min(num_related + 1, len(parent_ids)) # +1 because each hadith finds itself
+    scores, rows = blocked_search(parent_index, parent_vectors, k, block_size=QUERY_BLOCK_SIZE)
+
+    related = []
+    for own_row in range(len(parent_ids)):
+        neighbours = [(float(score), int(parent_ids[row])) for score, row in zip(scores[own_row], rows[own_row])
+                      if row != -1 and row != own_row]
+        related.append(neighbours[:num_related])
+    return related
+
+# --- Write to SQLite ---
+def write_related_table(db_path, parent_ids, related, collection_by_id):
+    conn = sqlite3.connect(db_path)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DROP TABLE IF EXISTS related_hadiths")
+        # WITHOUT ROWID keeps the (hadith_id, rank) primary key as the only b-tree: compact and indexed
+        cursor.execute('''
+        CREATE TABLE related_hadiths (
+            hadith_id INTEGER NOT NULL,
+            rank INTEGER NOT NULL,
+            related_id INTEGER NOT NULL,
+            related_collection_id TEXT,
+            score REAL NOT NULL,
+            PRIMARY KEY (hadith_id, rank)
+        ) WITHOUT ROWID''')
+        rows = []
+        for parent_id, neighbours in zip(parent_ids, related):
+            for rank, (score, related_id) in enumerate(neighbours):
+                rows.append((int(parent_id), rank, related_id, collection_by_id.get(related_id), round(score, 4)))
+        cursor.executemany(
+            "INSERT INTO related_hadiths (hadith_id, rank, related_id, related_collection_id, score) VALUES (?, ?, ?, ?, ?)",
+            rows
+        )
+        conn.commit()
+        logging.info(f"Wrote {len(rows)} related_hadiths rows to {db_path}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+
+    logging.info(f"Loading index mapping from: {MAPPING_PATH}")
+    with open(MAPPING_PATH, 'r', encoding='utf-8') as f:
+        mapping = json.load(f)
+
+    collection_by_id = {}
+    if os.path.exists(HADITHS_JSON_PATH):
+        with open(HADITHS_JSON_PATH, 'r', encoding='utf-8') as f:
+            collection_by_id = {int(h["id"]): standardize_collection(h.get("title", "")) for h in json.load(f) if "id" in h}
+    else:
+        logging.warning(f"Hadiths JSON not found: {HADITHS_JSON_PATH}; related_collection_id will be empty.")
+
+    chunk_vectors = load_chunk_vectors()
+    parent_ids, parent_vectors = aggregate_parent_vectors(chunk_vectors, mapping)
+    related = compute_related(parent_ids, parent_vectors)
+
+    if not os.path.exists(DB_PATH):
+        raise FileNotFoundError(f"SQLite DB not found: {DB_PATH}")
+    write_related_table(DB_PATH, parent_ids, related, collection_by_id)
+    logging.info(f"Related hadiths built in {time.perf_counter() - start:.1f}s.")
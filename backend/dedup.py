@@ -0,0 +1,107 @@
+# dedup.py (Exact + MinHash near-duplicate detection for index chunks)
+
+import re
+import zlib
+import hashlib
+import logging
+import numpy as np
+
+# --- Configuration ---
+NUM_PERMUTATIONS = 128 # MinHash signature length
+LSH_BANDS = 16         # 16 bands x 8 rows: pairs above ~0.7 Jaccard become candidates
+SHINGLE_SIZE = 3       # Word n-grams
+NEAR_DUPLICATE_THRESHOLD = 0.85 # Estimated Jaccard needed to merge two chunks
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+# --- Canonical Text for Hashing ---
+def canonical_text(text):
+    """Lowercases, drops diacritics/punctuation and collapses whitespace so trivial variants hash equal."""
+    if not text: return ""
+    text = re.sub(r'[\u064B-\u065F\u0670\u0640]', '', text.lower())
+    text = re.sub(r'[أإآ]', 'ا', text)
+    text = re.sub(r'ى', 'ي', text)
+    text = re.sub(r'ة', 'ه', text)
+    text = re.sub(r'[^\w\s]', ' ', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+def _shingle_hashes(text):
+    words = text.split()
+    if len(words) <= SHINGLE_SIZE:
+        shingles = [" ".join(words)]
+    else:
+        shingles = [" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)]
+    return np.array(sorted({zlib.crc32(s.encode('utf-8')) for s in shingles}), dtype=np.uint64)
+
+# --- MinHash ---
+class MinHasher:
+    """Computes fixed-length MinHash signatures with random affine hash permutations."""
+
+    def __init__(self, num_perm=NUM_PERMUTATIONS, seed=42):
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, _MERSENNE_PRIME, size=(num_perm, 1), dtype=np.uint64)
+        self.b = rng.randint(0, _MERSENNE_PRIME, size=(num_perm, 1), dtype=np.uint64)
+
+    def signature(self, text):
+        hashes = _shingle_hashes(text)
+        permuted = ((self.a * hashes[np.newaxis, :] + self.b) % _MERSENNE_PRIME) & _MAX_HASH
+        return permuted.min(axis=1)
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+def _union(parent, i, j):
+    root_i, root_j = _find(parent, i), _find(parent, j)
+    if root_i != root_j:
+        parent[max(root_i, root_j)] = min(root_i, root_j) # Lowest position stays the representative
+
+# --- Clustering ---
+def find_duplicate_clusters(texts, threshold=NEAR_DUPLICATE_THRESHOLD, near_duplicates=True):
+    """Groups exact and near-duplicate texts.
+
+    Returns a list of clusters, each a list of positions into `texts`; the first
+    position of every cluster is its representative. Clusters are ordered by
+    representative position, so a corpus without duplicates maps 1:1.
+    """
+    parent = list(range(len(texts)))
+
+    # Stage 1: exact duplicates after canonicalization
+    canonical = [canonical_text(t) for t in texts]
+    first_by_hash = {}
+    for i, text in enumerate(canonical):
+        digest = hashlib.sha1(text.encode('utf-8')).digest()
+        if digest in first_by_hash:
+            _union(parent, first_by_hash[digest], i)
+        else:
+            first_by_hash[digest] = i
+    exact_unique = sorted(first_by_hash.values())
+    logging.info(f"Dedup: {len(texts)} chunks, {len(exact_unique)} after exact-hash collapse.")
+
+    # Stage 2: MinHash LSH over the exact-unique representatives
+    if near_duplicates and len(exact_unique) > 1:
+        hasher = MinHasher()
+        rows = NUM_PERMUTATIONS // LSH_BANDS
+        signatures = np.stack([hasher.signature(canonical[i]) for i in exact_unique])
+        merged = 0
+        for band in range(LSH_BANDS):
+            buckets = {}
+            band_values = signatures[:, band * rows:(band + 1) * rows]
+            for pos, key in enumerate(map(bytes, band_values)):
+                if key not in buckets:
+                    buckets[key] = pos
+                    continue
+                first = buckets[key]
+                # Verify against the bucket's first member only: keeps large buckets linear
+                similarity = np.mean(signatures[first] == signatures[pos])
+                if similarity >= threshold and _find(parent, exact_unique[first]) != _find(parent, exact_unique[pos]):
+                    _union(parent, exact_unique[first], exact_unique[pos])
+                    merged += 1
+        logging.info(f"Dedup: MinHash LSH merged {merged} near-duplicate groups (threshold {threshold}).")
+
+    clusters = {}
+    for i in range(len(texts)):
+        clusters.setdefault(_find(parent, i), []).append(i)
+    return [clusters[root] for root in sorted(clusters)]
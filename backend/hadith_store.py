@@ -0,0 +1,120 @@
+# hadith_store.py (Read-only, pooled access to hadith_data.db with an in-process LRU)
+
+import os
+import queue
+import sqlite3
+import hashlib
+import logging
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+# --- Configuration ---
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+CACHE_SIZE = int(os.environ.get("HADITH_CACHE_SIZE", "20000")) # Hadiths (and chapters) kept per LRU
+HASH_BLOCK_SIZE = 1 << 20
+
+HADITH_COLUMNS = "id, collection_id, chapter_id, book_id, id_in_book, english_narrator, english_text, arabic_text"
+
+def _hadith_row_to_dict(row) -> Dict:
+    """Same field names as SearchResult, so clients can reuse their hadith model."""
+    hadith_id, collection_id, chapter_id, book_id, id_in_book, narrator, english_text, arabic_text = row
+    return {
+        "id": hadith_id,
+        "idInBook": id_in_book,
+        "chapterId": chapter_id,
+        "bookId": book_id,
+        "collectionId": collection_id,
+        "arabic": arabic_text,
+        "english": {"narrator": narrator, "text": english_text},
+    }
+
+def content_version(path: str) -> str:
+    """Hash of the file bytes: replicas holding the same DB agree regardless of when it was copied."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+class HadithStore:
+    """Indexed reads of hadith_data.db through a pool of read-only connections.
+
+    The database is immutable for a deployed data version, so results are cached
+    without expiry; `data_version` hashes the file contents for ETags. Hashing reads the
+    whole file once, which is why the store is opened by a background resource loader.
+    """
+
+    def __init__(self, db_path: str, pool_size: int = POOL_SIZE, cache_size: int = CACHE_SIZE):
+        self.db_path = db_path
+        self.data_version = content_version(db_path)
+        self._pool = queue.Queue()
+        for _ in range(pool_size):
+            conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+            conn.execute("PRAGMA query_only = ON")
+            self._pool.put(conn)
+        # Per-instance LRUs (a module-level lru_cache would outlive a reloaded store)
+        self.get_hadith = lru_cache(maxsize=cache_size)(self._get_hadith)
+        self.get_chapter = lru_cache(maxsize=cache_size)(self._get_chapter)
+        self.get_chapter_name = lru_cache(maxsize=cache_size)(self._get_chapter_name)
+        logging.info(f"Hadith store opened: {db_path} (data version {self.data_version}, {pool_size} connections)")
+
+    @contextmanager
+    def connection(self):
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    def _get_hadith(self, collection_id: str, id_in_book: int) -> Optional[Dict]:
+        with self.connection() as conn:
+            row = conn.execute(
+                f"SELECT {HADITH_COLUMNS} FROM hadiths WHERE collection_id = ? AND id_in_book = ?", # idx_hadiths_id_in_book
+                (collection_id, id_in_book)
+            ).fetchone()
+        return _hadith_row_to_dict(row) if row else None
+
+    def get_hadiths(self, keys: List[Tuple[str, int]]) -> List[Optional[Dict]]:
+        """Multi-get in request order; cached entries are served without touching the DB."""
+        return [self.get_hadith(collection_id, id_in_book) for collection_id, id_in_book in keys]
+
+    def _get_chapter(self, collection_id: str, chapter_id: int) -> Optional[Dict]:
+        with self.connection() as conn:
+            chapter = conn.execute(
+                "SELECT id, book_id, english_name, arabic_name FROM chapters WHERE collection_id = ? AND id = ?",
+                (collection_id, chapter_id)
+            ).fetchone()
+            if not chapter:
+                return None
+            rows = conn.execute(
+                f"SELECT {HADITH_COLUMNS} FROM hadiths WHERE collection_id = ? AND chapter_id = ? ORDER BY id_in_book", # idx_hadiths_chapter
+                (collection_id, chapter_id)
+            ).fetchall()
+        return {
+            "collectionId": collection_id,
+            "chapterId": chapter[0],
+            "bookId": chapter[1],
+            "englishName": chapter[2],
+            "arabicName": chapter[3],
+            "hadiths": [_hadith_row_to_dict(row) for row in rows],
+        }
+
+    def _get_chapter_name(self, collection_id: str, chapter_id: int) -> Optional[str]:
+        with self.connection() as conn:
+            row = conn.execute(
+                "SELECT english_name FROM chapters WHERE collection_id = ? AND id = ?",
+                (collection_id, chapter_id)
+            ).fetchone()
+        return row[0] if row else None
+
+    def get_related(self, hadith_id: int, limit: int) -> List[Tuple[int, float]]:
+        with self.connection() as conn:
+            return conn.execute(
+                "SELECT related_id, score FROM related_hadiths WHERE hadith_id = ? ORDER BY rank LIMIT ?",
+                (hadith_id, limit)
+            ).fetchall()
+
+    def close(self):
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
@@ -1,18 +1,38 @@
 # main.py (Using OpenAI, Parent Doc Strategy, and SQLite Chapter Lookup)
+# numpy, faiss and openai are imported lazily (in the loaders / request path) to keep cold start short.
 
-from fastapi import FastAPI, HTTPException
+from __future__ import annotations
+
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, TYPE_CHECKING
+from concurrent.futures import ThreadPoolExecutor
 import json
 import os
 import re
 import sys
-import numpy as np
-import faiss
-from openai import OpenAI
+import time
+import pickle
+import hmac
+import hashlib
+import threading
 import logging
 from dotenv import load_dotenv
 import sqlite3 # <--- Import sqlite3
+from serialization import json_response, project_result
+from profiling import SlowQueryLog, StageTimer, profile_for
+
+if TYPE_CHECKING:
+    import numpy as np
+    import faiss
+    from openai import OpenAI
+
+try:
+    from brotli_asgi import BrotliMiddleware # Optional: brotli with gzip fallback
+except ImportError:
+    BrotliMiddleware = None
 
 load_dotenv()
 
@@ -26,20 +46,61 @@ ASSETS_DIR = os.path.join(BASE_DIR, "..", "assets") # Define assets directory
 # Index/Mapping paths
 INDEX_PATH = os.path.join(BASE_DIR, "hadith_index_openai_small_recursive.faiss")
 MAPPING_PATH = os.path.join(BASE_DIR, "index_mapping_openai_small_recursive.json")
+# Two-stage retrieval: compact first-stage index + mmap'd float16 full vectors for rescoring
+COMPACT_INDEX_PATH_TEMPLATE = os.path.join(BASE_DIR, "hadith_index_openai_small_recursive_{dim}d.faiss")
+FULL_VECTORS_PATH = os.path.join(BASE_DIR, "hadith_vectors_openai_small_recursive_f16.npy")
+RETRIEVAL_MODE = os.environ.get("RETRIEVAL_MODE", "flat") # "flat" (full 1536-d index) or "two_stage"
+# Sharded scatter-gather mode (overrides RETRIEVAL_MODE): "local" spawns one worker process per
+# shard from the manifest, "remote" talks to shard_server.py instances listed in SHARD_URLS
+SHARD_MODE = os.environ.get("SHARD_MODE", "") # "", "local" or "remote"
+SHARD_MANIFEST_PATH = os.path.join(BASE_DIR, "shards", "manifest.json")
+SHARD_URLS = [url for url in os.environ.get("SHARD_URLS", "").split(",") if url]
+# Index version (written by build_index.py) and the popular-query warm-up artifact keyed to it
+INDEX_VERSION_PATH = os.path.join(BASE_DIR, "index_version.json")
+PRECOMPUTED_QUERIES_PATH = os.path.join(BASE_DIR, "precomputed_queries.json")
 # Data paths
 HADITHS_JSON_PATH = os.path.join(TRAINING_DIR, "hadiths.json")
 DB_PATH = os.path.abspath(os.path.join(ASSETS_DIR, "database", "hadith_data.db")) # <-- Path to SQLite DB
 
 OPENAI_MODEL = "text-embedding-3-small"
+MAX_MULTI_GET = 100 # Hadiths per /hadith/multi request
+MAX_RELATED = 10 # Neighbours stored per hadith (NUM_RELATED in build_related.py)
+# Profiling / slow-query capture (admin endpoints are disabled unless ADMIN_TOKEN is set)
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "500"))
+SLOW_QUERY_CAPACITY = int(os.environ.get("SLOW_QUERY_CAPACITY", "200"))
+MAX_PROFILE_SECONDS = 60
+# hadith_data.db is immutable per data version: direct-read URLs pinned to it with ?v=<data_version>
+# are cached forever, unversioned URLs are revalidated (cheap 304s) so a new DB reaches clients at once
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "public, no-cache"
+COMPRESSION_MIN_SIZE = 1024 # Bytes; smaller responses are sent uncompressed
+# Startup: resources load concurrently in a background thread; /ready flips once they are in
+BACKGROUND_LOADING = os.environ.get("BACKGROUND_LOADING", "1") == "1"
+USE_STARTUP_SNAPSHOT = os.environ.get("USE_STARTUP_SNAPSHOT", "1") == "1" # Pickled mapping/lookup, rebuilt when the JSON changes
+SNAPSHOT_DIR = os.path.join(BASE_DIR, "startup_snapshots")
 
 # --- FastAPI Initialization ---
 app = FastAPI(title="Hadith Semantic Search API (Parent Doc Strategy + DB Lookup)")
+if BrotliMiddleware is not None:
+    app.add_middleware(BrotliMiddleware, minimum_size=COMPRESSION_MIN_SIZE)
+else:
+    app.add_middleware(GZipMiddleware, minimum_size=COMPRESSION_MIN_SIZE)
 
 # --- Global Variables ---
 client: Optional[OpenAI] = None
-index: Optional[faiss.Index] = None
+index: Optional[faiss.Index] = None # First-stage compact index in two_stage mode
+full_vectors: Optional[np.ndarray] = None # mmap'd float16 vectors, two_stage mode only
+shard_coordinator = None # ShardCoordinator, SHARD_MODE only (then `index` stays None)
+hadith_store = None # HadithStore: pooled read-only hadith_data.db access
+slow_query_log = SlowQueryLog(SLOW_QUERY_MS, SLOW_QUERY_CAPACITY)
+loaded_index_version: Optional[str] = None # From index_version.json, recorded with slow queries
+precomputed_queries: Optional[Dict] = None # {"top_k": int, "queries": {normalized query: [[hadith id, score], ...]}}
 mapping: Optional[Dict[str, Dict]] = None
 hadith_lookup: Dict[str, Dict] = {}
+resources_ready = threading.Event()
+resource_timings: Dict[str, float] = {} # Seconds per resource, plus "total"
+result_cache: Dict[str, Dict] = {} # Validated, serializable result dicts per hadith id (without score)
 
 # --- Consistent Normalization Function ---
 # (Keep normalize_arabic_text as before)
@@ -75,6 +136,8 @@ def standardize_collection(title: str) -> str:
 # --- Function to get Chapter Name from DB ---
 def get_chapter_name(db_path: str, collection_id: str, chapter_id: int) -> Optional[str]:
     """Looks up the English chapter name from the SQLite database."""
+    if hadith_store is not None and db_path == hadith_store.db_path:
+        return hadith_store.get_chapter_name(collection_id, chapter_id) # Pooled + cached
     chapter_name = None
     conn = None
     try:
@@ -99,23 +162,88 @@ def get_chapter_name(db_path: str, collection_id: str, chapter_id: int) -> Optio
             conn.close()
     return chapter_name
 
-# --- Load Resources at Startup ---
-@app.on_event("startup")
-def load_resources():
-    global client, index, mapping, hadith_lookup
-    logging.info("Loading resources at startup...")
-
-    # Initialize OpenAI Client (same as before)
+# --- Startup Snapshots (pickle is several times faster to load than the JSON sources) ---
+def _file_fingerprint(path: str):
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+def load_json_with_snapshot(name: str, source_path: str, build):
+    """Loads `build(parsed_json)` from a pickled snapshot when it matches the source file, else from JSON."""
+    snapshot_path = os.path.join(SNAPSHOT_DIR, f"{name}.pkl")
+    fingerprint = _file_fingerprint(source_path)
+    if USE_STARTUP_SNAPSHOT and os.path.exists(snapshot_path):
+        try:
+            with open(snapshot_path, 'rb') as f:
+                snapshot = pickle.load(f)
+            if snapshot.get("fingerprint") == fingerprint:
+                logging.info(f"Loaded {name} from startup snapshot: {snapshot_path}")
+                return snapshot["data"]
+            logging.info(f"Startup snapshot for {name} is stale; rebuilding from {source_path}")
+        except Exception as e:
+            logging.warning(f"Could not read startup snapshot {snapshot_path}: {e}")
+
+    with open(source_path, 'r', encoding='utf-8') as f:
+        data = build(json.load(f))
+    if USE_STARTUP_SNAPSHOT:
+        try:
+            os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+            tmp_path = f"{snapshot_path}.{os.getpid()}.tmp" # Per process: workers cold-starting together must not share it
+            with open(tmp_path, 'wb') as f:
+                pickle.dump({"fingerprint": fingerprint, "data": data}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, snapshot_path)
+        except OSError as e:
+            logging.warning(f"Could not write startup snapshot {snapshot_path}: {e}")
+    return data
+
+# --- Resource Loaders (each runs in its own worker thread) ---
+def load_openai_client():
+    global client
     logging.info("Initializing OpenAI client...")
     api_key = os.environ.get("OPENAI_API_KEY")
     if not api_key:
         logging.error("OPENAI_API_KEY environment variable not set.")
-    else:
-        client = OpenAI(api_key=api_key)
-        logging.info("OpenAI client initialized.")
-
-    # Load FAISS Index (same as before)
-    if os.path.exists(INDEX_PATH):
+        return
+    from openai import OpenAI
+    client = OpenAI(api_key=api_key)
+    logging.info("OpenAI client initialized.")
+
+def load_index():
+    """Loads the full-precision index, or compact index + mmap'd full vectors in two_stage mode,
+    or connects to the index shards in SHARD_MODE."""
+    global index, full_vectors, shard_coordinator, loaded_index_version
+    import faiss
+    loaded_index_version = current_index_version()
+    if SHARD_MODE:
+        from shards import LocalShardClient, RemoteShardClient, ShardCoordinator, load_manifest
+        if SHARD_MODE == "remote":
+            clients = [RemoteShardClient(url) for url in SHARD_URLS]
+        else:
+            manifest, shard_paths = load_manifest(SHARD_MANIFEST_PATH)
+            logging.info(f"Starting {len(shard_paths)} local shard workers ({manifest['shard_by']} sharding)...")
+            clients = []
+            try:
+                for path in shard_paths:
+                    clients.append(LocalShardClient(path))
+            except Exception:
+                for started in clients: # Don't leave the workers that did start running
+                    started.close()
+                raise
+        shard_coordinator = ShardCoordinator(clients)
+        logging.info(f"Sharded index ready: {len(clients)} shards, {shard_coordinator.ntotal} vectors in total")
+    elif RETRIEVAL_MODE == "two_stage":
+        from two_stage import COMPACT_DIM, load_full_vectors
+        compact_index_path = COMPACT_INDEX_PATH_TEMPLATE.format(dim=COMPACT_DIM)
+        if os.path.exists(compact_index_path) and os.path.exists(FULL_VECTORS_PATH):
+            logging.info(f"Loading compact FAISS index from: {compact_index_path}")
+            loaded_vectors = load_full_vectors(FULL_VECTORS_PATH)
+            loaded_index = faiss.read_index(compact_index_path)
+            logging.info(f"Two-stage retrieval: {loaded_index.ntotal} vectors, {loaded_index.d}d first stage, {loaded_vectors.shape[1]}d rescoring (mmap)")
+            if loaded_vectors.shape[0] != loaded_index.ntotal:
+                logging.warning(f"Full vector count ({loaded_vectors.shape[0]}) doesn't match compact index ({loaded_index.ntotal}).")
+            full_vectors, index = loaded_vectors, loaded_index
+        else:
+            logging.error(f"Two-stage artifacts not found: {compact_index_path}, {FULL_VECTORS_PATH}")
+    elif os.path.exists(INDEX_PATH):
         logging.info(f"Loading FAISS index from: {INDEX_PATH}")
         index = faiss.read_index(INDEX_PATH)
         logging.info(f"FAISS index loaded. Total vectors: {index.ntotal}")
@@ -124,39 +252,110 @@ def load_resources():
     else:
         logging.error(f"FAISS index not found: {INDEX_PATH}")
 
-    # Load Mapping (same as before)
+def load_mapping():
+    global mapping
     if os.path.exists(MAPPING_PATH):
         logging.info(f"Loading index mapping from: {MAPPING_PATH}")
-        with open(MAPPING_PATH, 'r', encoding='utf-8') as f:
-            mapping_raw = json.load(f)
-            mapping = {str(k): v for k, v in mapping_raw.items()}
+        mapping = load_json_with_snapshot("mapping", MAPPING_PATH, lambda raw: {str(k): v for k, v in raw.items()})
         logging.info(f"Index mapping loaded. Total entries: {len(mapping)}")
     else:
         logging.error(f"Index mapping not found: {MAPPING_PATH}")
 
-    # Load Hadiths for Full Text Lookup (same as before)
+def load_hadith_lookup():
+    global hadith_lookup
     if os.path.exists(HADITHS_JSON_PATH):
          logging.info(f"Loading hadith details from: {HADITHS_JSON_PATH}")
-         with open(HADITHS_JSON_PATH, 'r', encoding='utf-8') as f:
-             all_hadiths = json.load(f)
-             hadith_lookup = {str(h["id"]): h for h in all_hadiths if "id" in h}
+         hadith_lookup = load_json_with_snapshot(
+             "hadith_lookup", HADITHS_JSON_PATH,
+             lambda all_hadiths: {str(h["id"]): h for h in all_hadiths if "id" in h}
+         )
          logging.info(f"Hadith lookup table created with {len(hadith_lookup)} entries.")
     else:
          logging.warning(f"Hadiths JSON not found for lookup: {HADITHS_JSON_PATH}")
 
-    # Check if DB exists
+def current_index_version() -> Optional[str]:
+    """The version build_index.py recorded for the index artifacts, or None for older builds."""
+    if not os.path.exists(INDEX_VERSION_PATH):
+        return None
+    with open(INDEX_VERSION_PATH, 'r', encoding='utf-8') as f:
+        return json.load(f).get("version")
+
+def load_precomputed_queries():
+    """Loads the popular-query artifact, ignoring it when it was built for another index version."""
+    global precomputed_queries
+    if not os.path.exists(PRECOMPUTED_QUERIES_PATH):
+        logging.info(f"No precomputed queries at {PRECOMPUTED_QUERIES_PATH}; every query goes to the index.")
+        return
+    with open(PRECOMPUTED_QUERIES_PATH, 'r', encoding='utf-8') as f:
+        artifact = json.load(f)
+    index_version = current_index_version()
+    if index_version is None or artifact.get("index_version") != index_version:
+        logging.warning(f"Precomputed queries built for index {artifact.get('index_version')}, current is {index_version}; ignoring them.")
+        return
+    precomputed_queries = artifact
+    logging.info(f"Loaded {len(artifact['queries'])} precomputed queries (top_k={artifact['top_k']}, index {index_version}).")
+
+def check_db():
+    global hadith_store
     if not os.path.exists(DB_PATH):
          logging.error(f"SQLite DB for chapter lookup not found at: {DB_PATH}")
     else:
          logging.info(f"SQLite DB found at: {DB_PATH}")
+         from hadith_store import HadithStore
+         hadith_store = HadithStore(DB_PATH)
+
+RESOURCE_LOADERS = {
+    "openai_client": load_openai_client,
+    "faiss_index": load_index,
+    "mapping": load_mapping,
+    "hadith_lookup": load_hadith_lookup,
+    "sqlite_db": check_db,
+    "precomputed_queries": load_precomputed_queries,
+}
+
+def _timed(name, loader):
+    start = time.perf_counter()
+    try:
+        loader()
+    except Exception:
+        logging.exception(f"Failed to load resource: {name}")
+    finally:
+        resource_timings[name] = round(time.perf_counter() - start, 3)
+
+def load_all_resources():
+    """Runs every resource loader concurrently and marks the service ready when all have finished."""
+    logging.info("Loading resources...")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(RESOURCE_LOADERS), thread_name_prefix="loader") as executor:
+        for name, loader in RESOURCE_LOADERS.items():
+            executor.submit(_timed, name, loader)
+    resource_timings["total"] = round(time.perf_counter() - start, 3)
+    resources_ready.set()
+    logging.info("Resource loading process finished. Timings (s): " + ", ".join(f"{k}={v}" for k, v in resource_timings.items()))
 
+# --- Load Resources at Startup ---
+@app.on_event("shutdown")
+def close_resources():
+    if shard_coordinator is not None:
+        shard_coordinator.close()
+    if hadith_store is not None:
+        hadith_store.close()
 
-    logging.info("Resource loading process finished.")
+@app.on_event("startup")
+def load_resources():
+    """Starts loading in the background so the server accepts connections (and /live) immediately."""
+    if BACKGROUND_LOADING:
+        threading.Thread(target=load_all_resources, name="resource-loader", daemon=True).start()
+    else:
+        load_all_resources()
 
 # --- Pydantic Models for API (Ensure chapterName is here) ---
 class SearchRequest(BaseModel):
     query: str
     top_k: int = 5
+    expand_duplicates: bool = True # Also return hadiths whose chunk was collapsed into the hit's vector
+    fields: Optional[List[str]] = None # Only return these SearchResult fields (id and retrieval_score always included)
+    snippet: Optional[int] = None # Cut arabic/english text to this many characters
 
 class SearchResult(BaseModel):
     id: int
@@ -172,115 +371,356 @@ class SearchResult(BaseModel):
 
 class SearchResponse(BaseModel):
     results: List[SearchResult]
+    partial: bool = False # True when some index shards did not answer in time
+
+# --- Result Construction (shared by /search and /related) ---
+def build_search_result(hadith_id_str: str, hadith_data: Dict, score: float) -> Optional[Dict]:
+    """Returns a SearchResult-shaped dict for a hadith, with collectionId and chapter name from the DB.
+
+    Each hadith is validated through SearchResult once; the dumped dict is cached so later
+    hits only copy it and set retrieval_score (no per-request validation or DB lookup).
+    """
+    cached = result_cache.get(hadith_id_str)
+    if cached is None:
+        # Calculate collectionId (ensure function is correct)
+        actual_title = hadith_data.get("title", "")
+        calculated_collection_id = standardize_collection(actual_title)
+        logging.debug(f"Processing Hadith ID={hadith_id_str}, Title='{actual_title}', Calculated CollectionId='{calculated_collection_id}'") # Use debug level
+
+        # --- Fetch Chapter Name from DB ---
+        retrieved_chapter_name = None
+        parent_chapter_id = hadith_data.get("chapterId")
+        if calculated_collection_id and parent_chapter_id is not None:
+            retrieved_chapter_name = get_chapter_name(
+                DB_PATH,
+                calculated_collection_id,
+                int(parent_chapter_id) # Ensure chapterId is int for lookup
+            )
+        else:
+             logging.warning(f"Missing collectionId or chapterId for Hadith {hadith_id_str}, cannot fetch chapter name.")
+        # ----------------------------------
+
+        # Validate once, then keep the plain dict
+        try:
+            cached = SearchResult(
+                **hadith_data,
+                collectionId=calculated_collection_id,
+                chapterName=retrieved_chapter_name, # Add the chapter name here
+                retrieval_score=0.0
+            ).model_dump()
+        except Exception as pydantic_error: # Catch potential Pydantic validation errors
+            logging.error(f"Pydantic validation error for Hadith ID {hadith_id_str}: {pydantic_error}")
+            logging.error(f"Data causing error: {hadith_data}")
+            return None
+        result_cache[hadith_id_str] = cached
+
+    return {**cached, "retrieval_score": float(score)}
+
+# --- Chunk Retrieval (flat or two-stage) ---
+def search_chunks(query_embedding: np.ndarray, k: int):
+    """Returns (scores, vector indices, failed shards) for the top-k chunks of an L2-normalized 1536-d query."""
+    if shard_coordinator is not None:
+        return shard_coordinator.search(query_embedding, k)
+    if full_vectors is not None:
+        from two_stage import SHORTLIST_FACTOR, two_stage_search
+        return (*two_stage_search(index, full_vectors, query_embedding, k, SHORTLIST_FACTOR), [])
+    return (*index.search(query_embedding, k), [])
+
+# --- Query Normalization (shared with precompute_queries.py) ---
+def normalize_query(query_text: str) -> str:
+    """Normalizes Arabic queries exactly like the indexed text; other queries are used as-is."""
+    if any('\u0600' <= char <= '\u06FF' for char in query_text):
+         return normalize_arabic_text(query_text)
+    return query_text
+
+# --- Retrieval Core (shared with precompute_queries.py) ---
+def search_with_embedding(query_embedding: np.ndarray, top_k: int, expand_duplicates: bool = True,
+                          timer: Optional[StageTimer] = None):
+    """Searches the index with an L2-normalized (1, d) query and returns (result dicts, failed shards)."""
+    timer = timer or StageTimer()
+    k_chunks = top_k * 5 # Fetch more potential chunks
+    logging.info(f"Searching index for top {k_chunks} relevant chunks...")
+    with timer.stage("index_search"):
+        distances, indices, failed_shards = search_chunks(query_embedding, k_chunks)
+    hydrate_start = time.perf_counter()
+
+    retrieved_hadiths = []
+    seen_parent_hadith_ids = set()
+    logging.info("Processing search results...")
+
+    for i in range(len(indices[0])):
+        vector_idx = indices[0][i]
+        if vector_idx == -1: continue
+
+        score = distances[0][i]
+        vector_idx_str = str(vector_idx)
+
+        if vector_idx_str not in mapping:
+            logging.warning(f"Vector index {vector_idx} not found in mapping. Skipping.")
+            continue
+
+        chunk_metadata = mapping[vector_idx_str]
+        # Deduplicated indexes store every hadith sharing this vector; older ones only the parent
+        parent_hadith_ids = chunk_metadata.get("parent_hadith_ids") or [chunk_metadata.get("parent_hadith_id")]
+        if not expand_duplicates:
+            parent_hadith_ids = parent_hadith_ids[:1]
+
+        for parent_hadith_id in parent_hadith_ids:
+            parent_hadith_id_str = str(parent_hadith_id)
+
+            if parent_hadith_id_str in seen_parent_hadith_ids:
+                continue
+
+            parent_hadith_data = hadith_lookup.get(parent_hadith_id_str)
+
+            if parent_hadith_data:
+                result_item = build_search_result(parent_hadith_id_str, parent_hadith_data, score)
+                if result_item is None:
+                    continue # Skip this hadith if data structure is wrong
+                retrieved_hadiths.append(result_item)
+                seen_parent_hadith_ids.add(parent_hadith_id_str)
+
+            else:
+                 logging.warning(f"Parent Hadith ID {parent_hadith_id_str} (from vector index {vector_idx}) not found in lookup.")
+
+            if len(retrieved_hadiths) >= top_k:
+                break
+
+        if len(retrieved_hadiths) >= top_k:
+            break
+
+    timer.add("hydrate", time.perf_counter() - hydrate_start)
+    return retrieved_hadiths, failed_shards
+
+def precomputed_search(normalized_query: str, top_k: int) -> Optional[List[Dict]]:
+    """Answers from the warm-up artifact when it covers this query and top_k, else None."""
+    if not precomputed_queries or top_k > precomputed_queries["top_k"]:
+        return None
+    hits = precomputed_queries["queries"].get(normalized_query)
+    if hits is None:
+        return None
+    results = []
+    for hadith_id_str, score in hits[:top_k]:
+        hadith_data = hadith_lookup.get(hadith_id_str)
+        result_item = build_search_result(hadith_id_str, hadith_data, score) if hadith_data else None
+        if result_item is not None:
+            results.append(result_item)
+    return results
 
 # --- Search Endpoint (MODIFIED) ---
 @app.post("/search", response_model=SearchResponse)
 def search_hadiths(search_request: SearchRequest):
     global client, index, mapping, hadith_lookup
 
+    if search_request.fields:
+        unknown_fields = set(search_request.fields) - set(SearchResult.model_fields)
+        if unknown_fields:
+            raise HTTPException(status_code=422, detail=f"Unknown fields: {', '.join(sorted(unknown_fields))}")
+    if search_request.snippet is not None and search_request.snippet < 1:
+        raise HTTPException(status_code=422, detail="snippet must be a positive number of characters")
+
+    timer = StageTimer()
+
+    # Popular queries precomputed at deploy time need neither the embedding API nor the index
+    with timer.stage("normalize"):
+        normalized_query = normalize_query(search_request.query)
+    if hadith_lookup and search_request.expand_duplicates:
+        with timer.stage("precomputed_lookup"):
+            precomputed_results = precomputed_search(normalized_query, search_request.top_k)
+        if precomputed_results is not None:
+            logging.info(f"Answering precomputed query: '{normalized_query[:50]}...'")
+            with timer.stage("serialize"):
+                response = json_response({"results": [project_result(r, search_request.fields, search_request.snippet) for r in precomputed_results]})
+            record_slow_query(search_request, normalized_query, timer, source="precomputed")
+            return response
+
     # Check essential resources needed for AI search
-    if not client or not index or not mapping or not hadith_lookup:
+    index_loaded = index is not None or shard_coordinator is not None
+    if not client or not index_loaded or not mapping or not hadith_lookup:
          missing = []
          if not client: missing.append("OpenAI client")
-         if not index: missing.append("FAISS index")
+         if not index_loaded: missing.append("FAISS index")
          if not mapping: missing.append("Index mapping")
          if not hadith_lookup: missing.append("Hadith lookup data")
          error_detail = f"Resources not loaded: {', '.join(missing)}"
          logging.error(error_detail)
          raise HTTPException(status_code=503, detail=error_detail)
 
-    try:
-        query_text = search_request.query
-        normalized_query = query_text
-        if any('\u0600' <= char <= '\u06FF' for char in query_text):
-             normalized_query = normalize_arabic_text(query_text)
+    import numpy as np
+    import faiss
 
+    try:
         logging.info(f"Encoding query: '{normalized_query[:50]}...'")
-        response = client.embeddings.create(input=normalized_query, model=OPENAI_MODEL)
-        query_embedding = np.array(response.data[0].embedding, dtype=np.float32).reshape(1, -1)
-        faiss.normalize_L2(query_embedding)
-
-        k_chunks = search_request.top_k * 5 # Fetch more potential chunks
-        logging.info(f"Searching index for top {k_chunks} relevant chunks...")
-        distances, indices = index.search(query_embedding, k_chunks)
-
-        retrieved_hadiths = []
-        seen_parent_hadith_ids = set()
-        logging.info("Processing search results...")
-
-        for i in range(len(indices[0])):
-            vector_idx = indices[0][i]
-            if vector_idx == -1: continue
-
-            score = distances[0][i]
-            vector_idx_str = str(vector_idx)
-
-            if vector_idx_str not in mapping:
-                logging.warning(f"Vector index {vector_idx} not found in mapping. Skipping.")
-                continue
-
-            chunk_metadata = mapping[vector_idx_str]
-            parent_hadith_id_str = str(chunk_metadata.get("parent_hadith_id"))
-
-            if parent_hadith_id_str in seen_parent_hadith_ids:
-                continue
-
-            parent_hadith_data = hadith_lookup.get(parent_hadith_id_str)
+        with timer.stage("embed"):
+            response = client.embeddings.create(input=normalized_query, model=OPENAI_MODEL)
+            query_embedding = np.array(response.data[0].embedding, dtype=np.float32).reshape(1, -1)
+            faiss.normalize_L2(query_embedding)
 
-            if parent_hadith_data:
-                # Calculate collectionId (ensure function is correct)
-                actual_title = parent_hadith_data.get("title", "")
-                calculated_collection_id = standardize_collection(actual_title)
-                logging.debug(f"Processing Hadith ID={parent_hadith_id_str}, Title='{actual_title}', Calculated CollectionId='{calculated_collection_id}'") # Use debug level
-
-                # --- Fetch Chapter Name from DB ---
-                retrieved_chapter_name = None
-                parent_chapter_id = parent_hadith_data.get("chapterId")
-                if calculated_collection_id and parent_chapter_id is not None:
-                    retrieved_chapter_name = get_chapter_name(
-                        DB_PATH,
-                        calculated_collection_id,
-                        int(parent_chapter_id) # Ensure chapterId is int for lookup
-                    )
-                else:
-                     logging.warning(f"Missing collectionId or chapterId for Hadith {parent_hadith_id_str}, cannot fetch chapter name.")
-                # ----------------------------------
-
-                # Create the final result object
-                try:
-                    result_item = SearchResult(
-                        **parent_hadith_data,
-                        collectionId=calculated_collection_id,
-                        chapterName=retrieved_chapter_name, # Add the chapter name here
-                        retrieval_score=float(score)
-                    )
-                    retrieved_hadiths.append(result_item)
-                    seen_parent_hadith_ids.add(parent_hadith_id_str)
-                except Exception as pydantic_error: # Catch potential Pydantic validation errors
-                    logging.error(f"Pydantic validation error for Hadith ID {parent_hadith_id_str}: {pydantic_error}")
-                    logging.error(f"Data causing error: {parent_hadith_data}")
-                    continue # Skip this hadith if data structure is wrong
-
-            else:
-                 logging.warning(f"Parent Hadith ID {parent_hadith_id_str} (from vector index {vector_idx}) not found in lookup.")
-
-            if len(retrieved_hadiths) >= search_request.top_k:
-                break
+        retrieved_hadiths, failed_shards = search_with_embedding(
+            query_embedding, search_request.top_k, search_request.expand_duplicates, timer
+        )
 
         logging.info(f"Returning {len(retrieved_hadiths)} unique Hadith results.")
-        return SearchResponse(results=retrieved_hadiths)
+        with timer.stage("serialize"):
+            results = [project_result(r, search_request.fields, search_request.snippet) for r in retrieved_hadiths]
+            payload = {"results": results}
+            if failed_shards:
+                payload["partial"] = True # Some shards timed out or failed; results cover the rest
+            response = json_response(payload)
+        record_slow_query(search_request, normalized_query, timer, source="index", failed_shards=failed_shards)
+        return response
 
     except Exception as e:
         logging.exception("An error occurred during search.")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
+def record_slow_query(search_request: SearchRequest, normalized_query: str, timer: StageTimer,
+                      source: str, failed_shards: Optional[List[str]] = None):
+    """Adds the request to the slow-query ring buffer when it took longer than SLOW_QUERY_MS."""
+    total_ms = timer.total() * 1000
+    recorded = slow_query_log.maybe_record(total_ms, {
+        "query": search_request.query,
+        "normalized_query": normalized_query,
+        "top_k": search_request.top_k,
+        "source": source,
+        "stages_ms": timer.as_ms(),
+        "index_version": loaded_index_version,
+        "retrieval_mode": f"sharded-{SHARD_MODE}" if SHARD_MODE else RETRIEVAL_MODE,
+        "failed_shards": failed_shards or [],
+    })
+    if recorded:
+        logging.warning(f"Slow query ({total_ms:.0f} ms, top_k={search_request.top_k}): {timer.as_ms()}")
+
+# --- Related Hadiths Endpoint (precomputed by build_related.py) ---
+@app.get("/related/{hadith_id}", response_model=SearchResponse)
+def related_hadiths(hadith_id: int, limit: int = Query(MAX_RELATED, ge=1, le=MAX_RELATED)):
+    """Returns the precomputed semantic neighbours of a hadith from the related_hadiths table."""
+    global hadith_lookup
+
+    if not hadith_lookup:
+        raise HTTPException(status_code=503, detail="Resources not loaded: Hadith lookup data")
+
+    if hadith_store is None:
+        raise HTTPException(status_code=503, detail="Resources not loaded: SQLite DB")
+    try:
+        rows = hadith_store.get_related(hadith_id, limit)
+    except sqlite3.Error as e:
+        logging.error(f"Database error fetching related hadiths for {hadith_id}: {e}")
+        raise HTTPException(status_code=503, detail="Related hadiths table not available")
+
+    results = []
+    for related_id, score in rows:
+        related_data = hadith_lookup.get(str(related_id))
+        if not related_data:
+            logging.warning(f"Related Hadith ID {related_id} (for {hadith_id}) not found in lookup.")
+            continue
+        result_item = build_search_result(str(related_id), related_data, score)
+        if result_item is not None:
+            results.append(result_item)
+    return json_response({"results": results})
+
+# --- Direct Reads from hadith_data.db (immutable per data version, HTTP-cacheable) ---
+def direct_read_cache_headers(request: Request) -> Dict[str, str]:
+    """Cache headers for a direct-read URL, derived from the data version alone (no DB access).
+
+    Only URLs carrying the current version as `?v=` are marked immutable; anything else
+    (no `v`, or a stale one) must revalidate, since its content changes with the next DB.
+    The ETag is weak because the compression middleware serves gzip/br and identity bodies
+    under the same tag; a strong ETag would promise byte-identical representations.
+    """
+    data_version = hadith_store.data_version
+    url_key = hashlib.sha1(str(request.url.path + "?" + request.url.query).encode()).hexdigest()[:16]
+    pinned = request.query_params.get("v") == data_version
+    return {"ETag": f'W/"{data_version}-{url_key}"',
+            "Cache-Control": IMMUTABLE_CACHE_CONTROL if pinned else REVALIDATE_CACHE_CONTROL,
+            "X-Data-Version": data_version}
+
+def not_modified(request: Request, headers: Dict[str, str]) -> Optional[Response]:
+    """304 response when If-None-Match matches the ETag (weak comparison), else None."""
+    etag = headers["ETag"].removeprefix("W/")
+    if etag in [tag.strip().removeprefix("W/") for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    return None
+
+def require_hadith_store():
+    if hadith_store is None:
+        raise HTTPException(status_code=503, detail="Resources not loaded: SQLite DB")
+
+@app.get("/hadith/multi")
+def get_hadiths_multi(request: Request, ids: List[str] = Query(..., description="collectionId:idInBook, repeatable")):
+    """Batch read of hadiths by (collectionId, idInBook); missing ones come back as null, in request order."""
+    require_hadith_store()
+    if len(ids) > MAX_MULTI_GET:
+        raise HTTPException(status_code=422, detail=f"At most {MAX_MULTI_GET} ids per request")
+    keys = []
+    for key in ids:
+        collection_id, _, id_in_book = key.partition(":")
+        if not collection_id or not id_in_book.isdigit():
+            raise HTTPException(status_code=422, detail=f"Invalid id '{key}', expected collectionId:idInBook")
+        keys.append((collection_id, int(id_in_book)))
+    headers = direct_read_cache_headers(request)
+    cached_response = not_modified(request, headers)
+    if cached_response:
+        return cached_response
+    return json_response({"results": hadith_store.get_hadiths(keys)}, headers=headers)
+
+@app.get("/hadith/{collection_id}/{id_in_book}")
+def get_hadith(request: Request, collection_id: str, id_in_book: int):
+    require_hadith_store()
+    headers = direct_read_cache_headers(request)
+    cached_response = not_modified(request, headers) # Checked before touching the DB or the LRU
+    if cached_response:
+        return cached_response
+    hadith = hadith_store.get_hadith(collection_id, id_in_book)
+    if hadith is None:
+        raise HTTPException(status_code=404, detail=f"Hadith {collection_id}:{id_in_book} not found")
+    return json_response(hadith, headers=headers)
+
+@app.get("/chapter/{collection_id}/{chapter_id}")
+def get_chapter(request: Request, collection_id: str, chapter_id: int):
+    require_hadith_store()
+    headers = direct_read_cache_headers(request)
+    cached_response = not_modified(request, headers)
+    if cached_response:
+        return cached_response
+    chapter = hadith_store.get_chapter(collection_id, chapter_id)
+    if chapter is None:
+        raise HTTPException(status_code=404, detail=f"Chapter {collection_id}/{chapter_id} not found")
+    return json_response(chapter, headers=headers)
+
+# --- Admin: Sampling Profiler and Slow Queries (require ADMIN_TOKEN) ---
+def require_admin(request: Request):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(request.headers.get("x-admin-token", "").encode(), ADMIN_TOKEN.encode()): # Constant time
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+@app.get("/admin/profile")
+def admin_profile(request: Request, seconds: float = 10.0, interval_ms: float = 10.0):
+    """Samples every thread for `seconds` and returns a folded-stack profile (flamegraph.pl / speedscope)."""
+    require_admin(request)
+    if not 0 < seconds <= MAX_PROFILE_SECONDS or interval_ms < 1:
+        raise HTTPException(status_code=422, detail=f"seconds must be in (0, {MAX_PROFILE_SECONDS}] and interval_ms >= 1")
+    try:
+        folded = profile_for(seconds, interval_ms / 1000)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return Response(content=folded, media_type="text/plain",
+                    headers={"Content-Disposition": f'attachment; filename="profile-{int(time.time())}.folded"'})
+
+@app.get("/admin/slow-queries")
+def admin_slow_queries(request: Request):
+    require_admin(request)
+    return json_response({"threshold_ms": slow_query_log.threshold_ms, "queries": slow_query_log.entries()})
+
 # --- Health Check Endpoint (No DB check needed unless critical) ---
 @app.get("/health")
 def health_check():
     status_items = []
     if client: status_items.append("OpenAI client: OK")
     else: status_items.append("OpenAI client: Missing")
-    if index: status_items.append("FAISS index: OK")
+    index_loaded = index is not None or shard_coordinator is not None
+    if index_loaded: status_items.append("FAISS index: OK")
     else: status_items.append("FAISS index: Missing")
     if mapping: status_items.append("Mapping: OK")
     else: status_items.append("Mapping: Missing")
@@ -291,10 +731,29 @@ def health_check():
     else: status_items.append("SQLite DB File: Missing")
 
     # AI search can function without DB chapters, but lookup data is important
-    is_healthy = client and index and mapping and hadith_lookup
-    status = "healthy" if is_healthy else "partially unhealthy" # Adjust status logic
-
-    return {"status": status, "details": status_items}
+    is_healthy = client and index_loaded and mapping and hadith_lookup
+    if not resources_ready.is_set():
+        status = "loading"
+    else:
+        status = "healthy" if is_healthy else "partially unhealthy" # Adjust status logic
+
+    return {"status": status, "details": status_items, "startup_timings": resource_timings,
+            "data_version": hadith_store.data_version if hadith_store else None} # For ?v= on direct-read URLs
+
+# --- Liveness / Readiness Probes ---
+@app.get("/live")
+def liveness_check():
+    """The process is up and serving HTTP (resources may still be loading)."""
+    return {"status": "alive"}
+
+@app.get("/ready")
+def readiness_check():
+    """200 once startup loading has finished and search can be served, 503 before that."""
+    can_search = bool(client and (index is not None or shard_coordinator is not None) and mapping and hadith_lookup)
+    if resources_ready.is_set() and can_search:
+        return {"status": "ready", "startup_timings": resource_timings}
+    status = "loading" if not resources_ready.is_set() else "not ready"
+    return JSONResponse(status_code=503, content={"status": status, "startup_timings": resource_timings})
 
 # --- Main execution ---
 if __name__ == "__main__":
@@ -0,0 +1,91 @@
+# precompute_queries.py (Deploy-time warm-up: precomputes top-k results for popular queries)
+#
+# Usage: python precompute_queries.py popular_queries.txt [query_log.txt ...] [--top-k 50] [--limit 5000]
+# Input files hold one query per line (a query log or a curated list of topics/phrases) or a
+# JSON list of strings. Queries are normalized exactly like /search, ranked by frequency, embedded
+# in batches and searched against the current index. The artifact records the index version and
+# main.py ignores it once the index is rebuilt.
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from collections import Counter
+import numpy as np
+import faiss
+from tqdm import tqdm
+
+import main # Reuses the server's loaders, normalization and retrieval code
+
+API_BATCH_SIZE = 200
+DEFAULT_TOP_K = 50 # Largest top_k answered from the artifact
+DEFAULT_LIMIT = 5000 # Most frequent distinct queries kept
+
+def read_queries(paths):
+    """Counts normalized queries across all input files."""
+    counts = Counter()
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            if path.endswith(".json"):
+                queries = json.load(f)
+            else:
+                queries = f.read().splitlines()
+        for query in queries:
+            query = query.strip()
+            if query:
+                counts[main.normalize_query(query)] += 1
+    return counts
+
+def embed_queries(queries):
+    embeddings = []
+    for i in tqdm(range(0, len(queries), API_BATCH_SIZE), desc="Embedding queries"):
+        response = main.client.embeddings.create(input=queries[i:i + API_BATCH_SIZE], model=main.OPENAI_MODEL)
+        embeddings.extend(item.embedding for item in response.data)
+    embeddings = np.array(embeddings, dtype=np.float32)
+    faiss.normalize_L2(embeddings)
+    return embeddings
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("query_files", nargs="+")
+    parser.add_argument("--top-k", type=int, default=DEFAULT_TOP_K)
+    parser.add_argument("--limit", type=int, default=DEFAULT_LIMIT)
+    parser.add_argument("--output", default=main.PRECOMPUTED_QUERIES_PATH)
+    args = parser.parse_args()
+
+    index_version = main.current_index_version()
+    if index_version is None:
+        sys.exit(f"No index version at {main.INDEX_VERSION_PATH}; rebuild the index with build_index.py first.")
+
+    main.USE_STARTUP_SNAPSHOT = False
+    main.RESOURCE_LOADERS.pop("precomputed_queries", None) # Never answer from the artifact being rebuilt
+    main.load_all_resources()
+    if not main.client or (main.index is None and main.shard_coordinator is None) or not main.mapping or not main.hadith_lookup:
+        sys.exit("Resources failed to load; see the log above.")
+
+    counts = read_queries(args.query_files)
+    queries = [query for query, _ in counts.most_common(args.limit)]
+    logging.info(f"{len(counts)} distinct normalized queries, precomputing the top {len(queries)}.")
+
+    start = time.perf_counter()
+    embeddings = embed_queries(queries)
+    entries = {}
+    for query, embedding in zip(tqdm(queries, desc="Searching"), embeddings):
+        results, failed_shards = main.search_with_embedding(embedding.reshape(1, -1), args.top_k)
+        if failed_shards:
+            logging.warning(f"Skipping '{query[:50]}': shards {failed_shards} did not answer.")
+            continue
+        entries[query] = [[str(r["id"]), round(r["retrieval_score"], 6)] for r in results]
+
+    artifact = {
+        "index_version": index_version,
+        "model": main.OPENAI_MODEL,
+        "top_k": args.top_k,
+        "created_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "queries": entries,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(artifact, f, ensure_ascii=False)
+    logging.info(f"Wrote {len(entries)} precomputed queries to {args.output} in {time.perf_counter() - start:.1f}s.")
@@ -0,0 +1,162 @@
+# profiling.py (Low-overhead sampling profiler, per-stage timers and a slow-query ring buffer)
+#
+# The sampler snapshots every thread's Python stack with sys._current_frames() at a fixed
+# interval and counts identical stacks, producing the "folded" format read by flamegraph.pl,
+# speedscope and inferno. Nothing is traced in between samples, so overhead stays at a few
+# percent even at 100 Hz and it is safe to run against production traffic.
+
+import os
+import sys
+import time
+import logging
+import threading
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+# --- Configuration ---
+DEFAULT_INTERVAL_SECONDS = 0.01 # 100 Hz
+MAX_STACK_DEPTH = 128
+
+# --- Sampling Profiler ---
+class SamplingProfiler:
+    """Samples all Python threads in a background thread; `folded()` returns the collapsed stacks."""
+
+    def __init__(self, interval: float = DEFAULT_INTERVAL_SECONDS):
+        self.interval = interval
+        self.samples = Counter()
+        self.sample_count = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def _frame_label(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _sample_once(self):
+        own_id = threading.get_ident()
+        thread_names = {t.ident: t.name for t in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            stack = []
+            while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                stack.append(self._frame_label(frame))
+                frame = frame.f_back
+            stack.append(thread_names.get(thread_id, str(thread_id)))
+            self.samples[";".join(reversed(stack))] += 1
+        self.sample_count += 1
+
+    def _run(self):
+        next_sample = time.perf_counter()
+        while not self._stop.is_set():
+            self._sample_once()
+            next_sample += self.interval
+            self._stop.wait(max(0.0, next_sample - time.perf_counter()))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def folded(self) -> str:
+        """One `frame;frame;frame count` line per distinct stack, hottest first."""
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common()) + "\n"
+
+_profile_lock = threading.Lock()
+
+def profile_for(seconds: float, interval: float = DEFAULT_INTERVAL_SECONDS) -> str:
+    """Samples the whole process for `seconds` and returns a folded profile. One run at a time."""
+    if not _profile_lock.acquire(blocking=False):
+        raise RuntimeError("A profiling run is already in progress")
+    try:
+        profiler = SamplingProfiler(interval)
+        profiler.start()
+        time.sleep(seconds)
+        profiler.stop()
+        logging.info(f"Profiling run finished: {profiler.sample_count} samples over {seconds}s")
+        return profiler.folded()
+    finally:
+        _profile_lock.release()
+
+# --- Per-stage Timing ---
+class StageTimer:
+    """Accumulates wall time per named stage of one request or build."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings: Dict[str, float] = {}
+        self._last_lap = self.started
+
+    def add(self, name: str, seconds: float):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def lap(self, name: str):
+        """Charges the time since the previous lap (or creation) to `name`."""
+        now = time.perf_counter()
+        self.add(name, now - self._last_lap)
+        self._last_lap = now
+
+    def total(self) -> float:
+        return time.perf_counter() - self.started
+
+    def as_ms(self) -> Dict[str, float]:
+        return {name: round(seconds * 1000, 2) for name, seconds in self.timings.items()}
+
+# --- Slow-query Recorder ---
+class SlowQueryLog:
+    """Keeps the last `capacity` requests slower than `threshold_ms` in a ring buffer."""
+
+    def __init__(self, threshold_ms: float, capacity: int = 200):
+        self.threshold_ms = threshold_ms
+        self._entries = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+
+    def maybe_record(self, total_ms: float, entry: Dict) -> bool:
+        if total_ms < self.threshold_ms:
+            return False
+        with self._lock:
+            self._entries.append({**entry, "total_ms": round(total_ms, 2), "recorded_at": time.strftime('%Y-%m-%dT%H:%M:%S')})
+        return True
+
+    def entries(self) -> List[Dict]:
+        with self._lock:
+            return list(self._entries)
+
+# --- Offline Build Profiling ---
+class BuildProfiler:
+    """Stage timings for a batch script, plus a whole-run folded profile when `output_path` is set."""
+
+    def __init__(self, output_path: Optional[str] = None, interval: float = DEFAULT_INTERVAL_SECONDS):
+        self.output_path = output_path
+        self.timer = StageTimer()
+        self.sampler = SamplingProfiler(interval) if output_path else None
+        if self.sampler:
+            self.sampler.start()
+            logging.info(f"Sampling profiler running; profile will be written to {output_path}")
+
+    def lap(self, name: str):
+        self.timer.lap(name)
+
+    def finish(self):
+        total = self.timer.total()
+        logging.info("Stage timings: " + ", ".join(f"{name}={seconds:.1f}s ({seconds / total:.0%})"
+                                                     for name, seconds in self.timer.timings.items()))
+        if self.sampler:
+            self.sampler.stop()
+            with open(self.output_path, 'w', encoding='utf-8') as f:
+                f.write(self.sampler.folded())
+            logging.info(f"Folded profile ({self.sampler.sample_count} samples) written to {self.output_path}")
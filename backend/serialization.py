@@ -0,0 +1,51 @@
+# serialization.py (Lean JSON responses: field projection, snippets, orjson when available)
+
+import json
+from typing import Dict, List, Optional
+from fastapi import Response
+
+try:
+    import orjson
+except ImportError: # Optional: ~5-10x faster than the stdlib encoder for these payloads
+    orjson = None
+
+# Always returned, whatever `fields` asks for
+ALWAYS_INCLUDED_FIELDS = ("id", "retrieval_score")
+
+def dumps(payload) -> bytes:
+    """Serializes plain dicts/lists to UTF-8 JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def json_response(payload, headers: Optional[Dict[str, str]] = None) -> Response:
+    """Returns pre-serialized JSON, bypassing FastAPI's response_model re-validation and encoder."""
+    return Response(content=dumps(payload), media_type="application/json", headers=headers)
+
+def make_snippet(text: Optional[str], length: int) -> Optional[str]:
+    """Cuts text to at most `length` characters on a word boundary, adding an ellipsis."""
+    if not text or len(text) <= length:
+        return text
+    cut = text[:length]
+    if ' ' in cut:
+        cut = cut[:cut.rindex(' ')]
+    return cut.rstrip() + "…"
+
+def project_result(result: Dict, fields: Optional[List[str]] = None, snippet: Optional[int] = None) -> Dict:
+    """Applies a `fields` projection and/or `snippet` truncation to one result dict.
+
+    With neither option the dict is returned unchanged (full payload).
+    """
+    if fields:
+        keep = set(fields).union(ALWAYS_INCLUDED_FIELDS)
+        projected = {key: value for key, value in result.items() if key in keep}
+    else:
+        projected = dict(result) if snippet else result
+
+    if snippet:
+        if projected.get("arabic"):
+            projected["arabic"] = make_snippet(projected["arabic"], snippet)
+        english = projected.get("english")
+        if isinstance(english, dict) and english.get("text"):
+            projected["english"] = {**english, "text": make_snippet(english["text"], snippet)}
+    return projected
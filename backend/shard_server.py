@@ -0,0 +1,47 @@
+# shard_server.py (Serves one index shard over HTTP for the remote scatter-gather mode)
+#
+# Usage: SHARD_INDEX_PATH=shards/shard_0.faiss uvicorn shard_server:app --port 8101
+
+import os
+import logging
+from typing import List
+import numpy as np
+import faiss
+from fastapi import FastAPI, HTTPException
+from pydantic import BaseModel
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+SHARD_INDEX_PATH = os.environ.get("SHARD_INDEX_PATH", "")
+
+app = FastAPI(title="Hadith Index Shard")
+shard_index = None
+
+@app.on_event("startup")
+def load_shard():
+    global shard_index
+    if not os.path.exists(SHARD_INDEX_PATH):
+        logging.error(f"Shard index not found: {SHARD_INDEX_PATH}")
+        return
+    shard_index = faiss.read_index(SHARD_INDEX_PATH)
+    logging.info(f"Shard loaded from {SHARD_INDEX_PATH}: {shard_index.ntotal} vectors")
+
+class ShardSearchRequest(BaseModel):
+    queries: List[List[float]]
+    k: int
+
+@app.get("/info")
+def shard_info():
+    if shard_index is None:
+        raise HTTPException(status_code=503, detail="Shard not loaded")
+    return {"ntotal": shard_index.ntotal, "dimension": shard_index.d}
+
+@app.post("/search")
+def shard_search(request: ShardSearchRequest):
+    if shard_index is None:
+        raise HTTPException(status_code=503, detail="Shard not loaded")
+    queries = np.array(request.queries, dtype=np.float32)
+    if shard_index.ntotal == 0:
+        return {"scores": [[] for _ in request.queries], "ids": [[] for _ in request.queries]}
+    scores, ids = shard_index.search(queries, min(request.k, shard_index.ntotal))
+    return {"scores": scores.tolist(), "ids": ids.tolist()}
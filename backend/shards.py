@@ -0,0 +1,270 @@
+# shards.py (Sharded FAISS index: shard building, local/remote shard clients and the scatter-gather coordinator)
+#
+# build_index.py writes one IndexIDMap2 per shard, keyed by *global* vector index, plus
+# a manifest. Every shard therefore returns ids that resolve in the single global mapping,
+# so merging per-shard top-k is a sort and the parent-document dedup in /search stays global.
+
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
+import faiss
+
+# --- Configuration ---
+SHARD_TIMEOUT_SECONDS = float(os.environ.get("SHARD_TIMEOUT_SECONDS", "2.0"))
+SHARD_WORKER_THREADS = int(os.environ.get("SHARD_WORKER_THREADS", "1")) # OpenMP threads per shard process
+SHARD_STARTUP_TIMEOUT_SECONDS = float(os.environ.get("SHARD_STARTUP_TIMEOUT_SECONDS", "120")) # Worker index load
+SHARD_MAX_IN_FLIGHT = int(os.environ.get("SHARD_MAX_IN_FLIGHT", "8")) # Concurrent requests per shard (own thread pool)
+
+# --- Building Shards ---
+def assign_shard(metadata, shard_by, num_shards, collection_order):
+    """Returns the shard number of one vector from its mapping metadata."""
+    if shard_by == "collection":
+        return collection_order.index(metadata["collection"])
+    return int(metadata["parent_hadith_id"]) % num_shards
+
+def write_shards(embeddings, mapping, output_dir, shard_by="hash", num_shards=4):
+    """Splits normalized vectors into per-shard IndexIDMap2(IndexFlatIP) files and writes manifest.json.
+
+    `mapping` is the vector_index -> metadata dict; with shard_by="collection" there is one
+    shard per collection and `num_shards` is ignored.
+    """
+    collection_order = sorted({m["collection"] for m in mapping.values()})
+    if shard_by == "collection":
+        num_shards = len(collection_order)
+    assignments = np.array([assign_shard(mapping[i], shard_by, num_shards, collection_order)
+                            for i in range(len(embeddings))], dtype=np.int64)
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = {"shard_by": shard_by, "num_shards": num_shards, "dimension": int(embeddings.shape[1]), "shards": []}
+    for shard in range(num_shards):
+        global_ids = np.nonzero(assignments == shard)[0].astype(np.int64)
+        shard_index = faiss.IndexIDMap2(faiss.IndexFlatIP(embeddings.shape[1]))
+        shard_index.add_with_ids(embeddings[global_ids], global_ids)
+        file_name = f"shard_{shard}.faiss"
+        faiss.write_index(shard_index, os.path.join(output_dir, file_name))
+        manifest["shards"].append({
+            "shard": shard,
+            "file": file_name,
+            "ntotal": int(shard_index.ntotal),
+            "collection": collection_order[shard] if shard_by == "collection" else None,
+        })
+        logging.info(f"Shard {shard}: {shard_index.ntotal} vectors -> {file_name}")
+    with open(os.path.join(output_dir, "manifest.json"), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+def load_manifest(manifest_path):
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    base_dir = os.path.dirname(manifest_path)
+    return manifest, [os.path.join(base_dir, s["file"]) for s in manifest["shards"]]
+
+# --- Local Shard Worker Processes ---
+def _worker_loop(index_path, conn, num_threads):
+    """Runs in a child process: owns one shard index and answers (request_id, queries, k, deadline) messages.
+
+    Requests whose wall-clock deadline has passed by the time they are read are dropped
+    unanswered: the caller has already given up on them.
+    """
+    faiss.omp_set_num_threads(num_threads)
+    shard_index = faiss.read_index(index_path)
+    conn.send(("ready", shard_index.ntotal))
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        request_id, queries, k, deadline = message
+        if time.time() > deadline:
+            continue
+        try:
+            if shard_index.ntotal == 0:
+                scores, ids = np.empty((len(queries), 0), dtype=np.float32), np.empty((len(queries), 0), dtype=np.int64)
+            else:
+                scores, ids = shard_index.search(queries, min(k, shard_index.ntotal))
+            conn.send((request_id, scores, ids))
+        except Exception as e:
+            conn.send((request_id, None, str(e)))
+
+class LocalShardClient:
+    """A shard served by a child process on this machine, talked to over a pipe.
+
+    Requests are pipelined: callers send under a short lock and wait on their own event,
+    while one reader thread routes every response to its caller by request id.
+    """
+
+    def __init__(self, index_path, num_threads=SHARD_WORKER_THREADS, startup_timeout=SHARD_STARTUP_TIMEOUT_SECONDS):
+        self.name = os.path.basename(index_path)
+        context = multiprocessing.get_context("spawn") # No fork of a threaded, OpenMP-initialized parent
+        self._conn, child_conn = context.Pipe()
+        self._process = context.Process(target=_worker_loop, args=(index_path, child_conn, num_threads),
+                                        name=f"shard-{self.name}", daemon=True)
+        self._process.start()
+        child_conn.close() # Only the worker holds this end now, so its death reaches us as EOF
+        self._send_lock = threading.Lock()
+        self._pending = {} # request_id -> {"event": Event, "result": (scores, ids) or None}
+        self._pending_lock = threading.Lock()
+        self._closed = False
+        try:
+            if not self._conn.poll(startup_timeout):
+                raise TimeoutError(f"Shard {self.name} did not finish loading within {startup_timeout}s")
+            _, self.ntotal = self._conn.recv()
+        except EOFError:
+            self._process.join(timeout=2)
+            self.close()
+            raise RuntimeError(f"Shard worker {self.name} exited while loading {index_path} (exit code {self._process.exitcode})")
+        except TimeoutError:
+            self.close()
+            raise
+        threading.Thread(target=self._read_responses, name=f"shard-reader-{self.name}", daemon=True).start()
+
+    def _read_responses(self):
+        while True:
+            try:
+                response_id, scores, ids = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._pending_lock:
+                slot = self._pending.pop(response_id, None)
+            if slot is not None: # None: the caller already timed out
+                slot["result"] = (scores, ids)
+                slot["event"].set()
+        self._closed = True
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        for slot in pending.values():
+            slot["result"] = (None, "worker exited")
+            slot["event"].set()
+
+    def search(self, queries, k, timeout):
+        if self._closed:
+            raise RuntimeError(f"Shard {self.name} worker is not running")
+        deadline = time.monotonic() + timeout
+        request_id = uuid.uuid4().hex
+        slot = {"event": threading.Event(), "result": None}
+        with self._pending_lock:
+            self._pending[request_id] = slot
+        try:
+            # A stalled worker stops draining the pipe, so even sending is bounded by the deadline
+            if not self._send_lock.acquire(timeout=timeout):
+                raise TimeoutError(f"Shard {self.name} did not accept the request within {timeout}s")
+            try:
+                self._conn.send((request_id, queries, k, time.time() + timeout))
+            finally:
+                self._send_lock.release()
+            if not slot["event"].wait(max(0.0, deadline - time.monotonic())):
+                raise TimeoutError(f"Shard {self.name} did not answer within {timeout}s")
+        finally:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+        scores, ids = slot["result"]
+        if scores is None:
+            raise RuntimeError(f"Shard {self.name} failed: {ids}")
+        return scores, ids
+
+    def close(self):
+        if self._send_lock.acquire(timeout=1):
+            try:
+                self._conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            finally:
+                self._send_lock.release()
+        self._process.join(timeout=2)
+        if self._process.is_alive():
+            self._process.terminate()
+        self._conn.close()
+
+class RemoteShardClient:
+    """A shard served over HTTP by shard_server.py."""
+
+    def __init__(self, url, max_in_flight=SHARD_MAX_IN_FLIGHT):
+        import requests
+        self.name = url
+        self._url = url.rstrip("/")
+        self._session = requests.Session()
+        # One pooled connection per in-flight request, so concurrent searches never queue for a socket
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self.ntotal = self._session.get(f"{self._url}/info", timeout=SHARD_TIMEOUT_SECONDS).json()["ntotal"]
+
+    def search(self, queries, k, timeout):
+        response = self._session.post(f"{self._url}/search", json={"queries": queries.tolist(), "k": k}, timeout=timeout)
+        response.raise_for_status()
+        body = response.json()
+        return np.array(body["scores"], dtype=np.float32), np.array(body["ids"], dtype=np.int64)
+
+    def close(self):
+        self._session.close()
+
+# --- Scatter-Gather Coordinator ---
+class ShardCoordinator:
+    """Fans a query out to every shard in parallel and merges the per-shard top-k.
+
+    Shards that fail or miss the timeout are skipped: the caller gets the merged results
+    of the shards that did answer plus the names of the ones that did not. Each shard has
+    its own thread pool and every request carries a deadline measured from submission, so
+    a stalled shard only backs up its own pool and queued work past its deadline is dropped
+    instead of delaying the healthy shards.
+    """
+
+    def __init__(self, clients, timeout=SHARD_TIMEOUT_SECONDS, max_in_flight=SHARD_MAX_IN_FLIGHT):
+        self.clients = clients
+        self.timeout = timeout
+        self.ntotal = sum(c.ntotal for c in clients)
+        self._executors = {id(c): ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix=f"shard-{i}")
+                           for i, c in enumerate(clients)}
+
+    @staticmethod
+    def _search_shard(client, queries, k, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"Shard {client.name}: deadline passed while queued")
+        return client.search(queries, k, remaining)
+
+    def search(self, queries, k):
+        """Returns (scores, ids, failed_shard_names) shaped like faiss search for a (n, d) query array."""
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        deadline = time.monotonic() + self.timeout
+        futures = {self._executors[id(c)].submit(self._search_shard, c, queries, k, deadline): c for c in self.clients}
+        done, not_done = wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+        for future in not_done:
+            future.cancel() # Still queued behind a slow shard: never run it
+
+        failed = [futures[f].name for f in not_done]
+        per_shard_scores, per_shard_ids = [], []
+        for future in done:
+            try:
+                scores, ids = future.result()
+                per_shard_scores.append(scores)
+                per_shard_ids.append(ids)
+            except Exception as e:
+                logging.warning(f"Shard {futures[future].name} failed: {e}")
+                failed.append(futures[future].name)
+        if failed:
+            logging.warning(f"Partial search results: {len(failed)}/{len(self.clients)} shards missing ({', '.join(failed)})")
+
+        merged_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        merged_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        if per_shard_scores:
+            all_scores = np.hstack(per_shard_scores)
+            all_ids = np.hstack(per_shard_ids)
+            all_scores[all_ids == -1] = -np.inf
+            order = np.argsort(-all_scores, axis=1)[:, :k]
+            width = order.shape[1]
+            merged_scores[:, :width] = np.take_along_axis(all_scores, order, axis=1)
+            merged_ids[:, :width] = np.take_along_axis(all_ids, order, axis=1)
+            merged_ids[merged_scores == -np.inf] = -1
+        return merged_scores, merged_ids, failed
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+        for executor in self._executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
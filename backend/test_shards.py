@@ -0,0 +1,197 @@
+# test_shards.py (Scatter-gather over real shard workers: merge correctness and partial results)
+#
+# Run from backend/: python -m pytest -q test_shards.py
+# Starts LocalShardClient worker processes and shard_server.py instances under uvicorn on
+# free local ports, and checks them against a single IndexFlatIP over the same vectors.
+
+import os
+import sys
+import time
+import signal
+import socket
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import numpy as np
+import faiss
+import pytest
+
+from shards import LocalShardClient, RemoteShardClient, ShardCoordinator, write_shards
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+NUM_VECTORS = 300
+DIMENSION = 32
+NUM_SHARDS = 3
+TOP_K = 10
+
+@pytest.fixture(scope="module")
+def corpus(tmp_path_factory):
+    """Normalized random vectors, their mapping and the shards written by write_shards."""
+    rng = np.random.RandomState(0)
+    embeddings = rng.randn(NUM_VECTORS, DIMENSION).astype(np.float32)
+    faiss.normalize_L2(embeddings)
+    mapping = {i: {"parent_hadith_id": i, "collection": f"c{i % 2}"} for i in range(NUM_VECTORS)}
+    shard_dir = tmp_path_factory.mktemp("shards")
+    manifest = write_shards(embeddings, mapping, str(shard_dir), shard_by="hash", num_shards=NUM_SHARDS)
+    shard_paths = [os.path.join(shard_dir, s["file"]) for s in manifest["shards"]]
+
+    queries = rng.randn(8, DIMENSION).astype(np.float32)
+    faiss.normalize_L2(queries)
+    flat_index = faiss.IndexFlatIP(DIMENSION)
+    flat_index.add(embeddings)
+    expected_scores, expected_ids = flat_index.search(queries, TOP_K)
+    return {"embeddings": embeddings, "mapping": mapping, "shard_paths": shard_paths, "queries": queries,
+            "expected_scores": expected_scores, "expected_ids": expected_ids}
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+@pytest.fixture(scope="module")
+def shard_servers(corpus):
+    """One shard_server.py process per shard; yields [(url, process), ...]."""
+    pytest.importorskip("uvicorn")
+    pytest.importorskip("requests")
+    import requests
+
+    servers = []
+    for path in corpus["shard_paths"]:
+        port = _free_port()
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "shard_server:app", "--host", "127.0.0.1", "--port", str(port)],
+            cwd=BASE_DIR, env={**os.environ, "SHARD_INDEX_PATH": path},
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        servers.append((f"http://127.0.0.1:{port}", process))
+    try:
+        for url, process in servers:
+            deadline = time.time() + 30
+            while True:
+                try:
+                    if requests.get(f"{url}/info", timeout=1).status_code == 200:
+                        break
+                except requests.ConnectionError:
+                    pass
+                if process.poll() is not None or time.time() > deadline:
+                    pytest.fail(f"Shard server {url} did not start")
+                time.sleep(0.1)
+        yield servers
+    finally:
+        for _, process in servers:
+            process.send_signal(signal.SIGCONT) # In case a test left it stopped
+            process.terminate()
+            process.wait(timeout=10)
+
+def _assert_matches_flat(coordinator, corpus):
+    scores, ids, failed = coordinator.search(corpus["queries"], TOP_K)
+    assert failed == []
+    np.testing.assert_array_equal(ids, corpus["expected_ids"])
+    np.testing.assert_allclose(scores, corpus["expected_scores"], rtol=1e-5, atol=1e-6)
+
+def test_local_shards_match_single_index(corpus):
+    coordinator = ShardCoordinator([LocalShardClient(path) for path in corpus["shard_paths"]], timeout=10)
+    try:
+        assert coordinator.ntotal == NUM_VECTORS
+        _assert_matches_flat(coordinator, corpus)
+    finally:
+        coordinator.close()
+
+def test_local_shard_that_fails_to_load_raises():
+    start = time.perf_counter()
+    with pytest.raises(RuntimeError, match="exited while loading"):
+        LocalShardClient(os.path.join(BASE_DIR, "no_such_shard.faiss"))
+    assert time.perf_counter() - start < 30
+
+def test_remote_shards_match_single_index(corpus, shard_servers):
+    coordinator = ShardCoordinator([RemoteShardClient(url) for url, _ in shard_servers], timeout=10)
+    try:
+        assert coordinator.ntotal == NUM_VECTORS
+        _assert_matches_flat(coordinator, corpus)
+    finally:
+        coordinator.close()
+
+def _expected_without_shard_0(corpus):
+    """Exact top-k over the vectors held by shards 1..n-1 (hash sharding: id % NUM_SHARDS != 0)."""
+    scores = corpus["queries"] @ corpus["embeddings"].T
+    scores[:, np.arange(NUM_VECTORS) % NUM_SHARDS == 0] = -np.inf
+    return np.argsort(-scores, axis=1)[:, :TOP_K]
+
+def _run_concurrent_load(coordinator, stalled_name, corpus, num_queries=60, concurrency=12, rate_per_second=40):
+    """Fires queries from many threads at a steady rate while shard 0 is stalled.
+
+    Every query must come back within the timeout (plus slack) with exactly the stalled
+    shard missing and the healthy shards' merged top-k intact.
+    """
+    expected_ids = _expected_without_shard_0(corpus)
+
+    def one_query(n):
+        time.sleep(n / rate_per_second)
+        start = time.perf_counter()
+        _, ids, failed = coordinator.search(corpus["queries"], TOP_K)
+        return time.perf_counter() - start, ids, failed
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(one_query, range(num_queries)))
+    for elapsed, ids, failed in outcomes:
+        assert failed == [stalled_name]
+        assert elapsed < coordinator.timeout + 1.0
+        np.testing.assert_array_equal(ids, expected_ids)
+
+def test_stalled_local_shard_under_concurrent_load(corpus):
+    coordinator = ShardCoordinator([LocalShardClient(path) for path in corpus["shard_paths"]], timeout=0.5)
+    stalled = coordinator.clients[0]
+    try:
+        os.kill(stalled._process.pid, signal.SIGSTOP)
+        _run_concurrent_load(coordinator, stalled.name, corpus)
+    finally:
+        os.kill(stalled._process.pid, signal.SIGCONT)
+        coordinator.close()
+
+def test_stalled_remote_shard_under_concurrent_load(corpus, shard_servers):
+    coordinator = ShardCoordinator([RemoteShardClient(url) for url, _ in shard_servers], timeout=0.5)
+    stalled_url, stalled_process = shard_servers[0]
+    try:
+        stalled_process.send_signal(signal.SIGSTOP)
+        _run_concurrent_load(coordinator, stalled_url, corpus)
+    finally:
+        stalled_process.send_signal(signal.SIGCONT)
+        coordinator.close()
+
+class _EmbeddingClient:
+    """Stands in for the OpenAI client: every query embeds to the same fixed vector."""
+
+    def __init__(self, vector):
+        response = SimpleNamespace(data=[SimpleNamespace(embedding=vector.tolist())])
+        self.embeddings = SimpleNamespace(create=lambda **kwargs: response)
+
+def test_stalled_shard_marks_search_partial(corpus, shard_servers, monkeypatch):
+    from fastapi.testclient import TestClient
+    import main
+
+    coordinator = ShardCoordinator([RemoteShardClient(url) for url, _ in shard_servers], timeout=1.0)
+    _, stalled_process = shard_servers[0]
+    hadith_lookup = {str(i): {"id": i, "title": "Sahih al-Bukhari", "arabic": f"arabic {i}"} for i in range(NUM_VECTORS)}
+    monkeypatch.setattr(main, "shard_coordinator", coordinator)
+    monkeypatch.setattr(main, "client", _EmbeddingClient(corpus["queries"][0]))
+    monkeypatch.setattr(main, "mapping", {str(i): m for i, m in corpus["mapping"].items()})
+    monkeypatch.setattr(main, "hadith_lookup", hadith_lookup)
+    monkeypatch.setattr(main, "precomputed_queries", None)
+    monkeypatch.setattr(main, "result_cache", {})
+    api = TestClient(main.app) # No startup event: resources are the ones patched in above
+
+    try:
+        body = api.post("/search", json={"query": "mercy", "top_k": 5}).json()
+        assert body.get("partial", False) is False
+        assert [r["id"] for r in body["results"]] == corpus["expected_ids"][0][:5].tolist()
+
+        stalled_process.send_signal(signal.SIGSTOP)
+        start = time.perf_counter()
+        body = api.post("/search", json={"query": "mercy", "top_k": 5}).json()
+        assert time.perf_counter() - start < 5
+        assert body["partial"] is True
+        returned_ids = [r["id"] for r in body["results"]]
+        assert returned_ids and all(i % NUM_SHARDS != 0 for i in returned_ids) # shard_0 holds ids with id % NUM_SHARDS == 0
+    finally:
+        stalled_process.send_signal(signal.SIGCONT)
+        coordinator.close()
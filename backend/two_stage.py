@@ -0,0 +1,76 @@
+# two_stage.py (Shortened-dimension first stage + full-precision rescoring)
+#
+# text-embedding-3 models are trained so that a prefix of the embedding, renormalized,
+# is itself a usable embedding (the same thing the API's `dimensions` parameter returns).
+# The compact index searches those prefixes; the shortlist is then rescored exactly
+# against the full vectors, which are read from an mmap'd float16 .npy file.
+
+import numpy as np
+import faiss
+
+# --- Configuration ---
+COMPACT_DIM = 256            # First-stage dimension (256 or 512)
+COMPACT_QUANTIZATION = "int8" # "float" (IndexFlatIP) or "int8" (8-bit scalar quantizer)
+SHORTLIST_FACTOR = 4         # First stage returns k * SHORTLIST_FACTOR candidates for rescoring
+
+# --- Vector Preparation ---
+def truncate_and_normalize(vectors, dim=COMPACT_DIM):
+    """Keeps the first `dim` components of each row and L2-renormalizes them."""
+    truncated = np.ascontiguousarray(vectors[:, :dim], dtype=np.float32)
+    faiss.normalize_L2(truncated)
+    return truncated
+
+def build_compact_index(full_vectors, dim=COMPACT_DIM, quantization=COMPACT_QUANTIZATION):
+    """Builds the first-stage inner-product index over truncated vectors."""
+    compact_vectors = truncate_and_normalize(full_vectors, dim)
+    if quantization == "int8":
+        compact_index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        compact_index.train(compact_vectors)
+    elif quantization == "float":
+        compact_index = faiss.IndexFlatIP(dim)
+    else:
+        raise ValueError(f"Unknown compact index quantization: {quantization}")
+    compact_index.add(compact_vectors)
+    return compact_index
+
+def save_full_vectors(path, full_vectors):
+    np.save(path, full_vectors.astype(np.float16))
+
+def load_full_vectors(path):
+    """Memory-maps the float16 full vectors; pages are only read for rescored rows."""
+    return np.load(path, mmap_mode='r')
+
+# --- Search ---
+def two_stage_search(compact_index, full_vectors, query_embeddings, k, shortlist_factor=SHORTLIST_FACTOR):
+    """Searches the compact index, then rescores the shortlist with full vectors.
+
+    `query_embeddings` are full-dimension, L2-normalized float32 rows. Returns
+    (scores, indices) shaped like faiss `index.search`, padded with -1.
+    """
+    shortlist_k = min(k * shortlist_factor, compact_index.ntotal)
+    _, shortlist = compact_index.search(truncate_and_normalize(query_embeddings, compact_index.d), shortlist_k)
+
+    scores = np.full((len(query_embeddings), k), -np.inf, dtype=np.float32)
+    indices = np.full((len(query_embeddings), k), -1, dtype=np.int64)
+    for row, candidates in enumerate(shortlist):
+        candidates = candidates[candidates != -1]
+        if len(candidates) == 0: continue
+        # Sorted row order makes the mmap reads sequential
+        candidates = np.sort(candidates)
+        exact = np.asarray(full_vectors[candidates], dtype=np.float32) @ query_embeddings[row]
+        order = np.argsort(-exact)[:k]
+        scores[row, :len(order)] = exact[order]
+        indices[row, :len(order)] = candidates[order]
+    return scores, indices
+
+# --- Build-time Recall Check ---
+def compare_recall(full_index, compact_index, full_vectors, query_embeddings, k=10, shortlist_factor=SHORTLIST_FACTOR):
+    """Recall@k of the compact index alone and of two-stage search, against exact full-dimension search."""
+    _, exact = full_index.search(query_embeddings, k)
+    _, first_stage = compact_index.search(truncate_and_normalize(query_embeddings, compact_index.d), k)
+    _, rescored = two_stage_search(compact_index, full_vectors, query_embeddings, k, shortlist_factor)
+
+    def recall(found):
+        return float(np.mean([len(set(f) & set(e)) / len(e) for f, e in zip(found, exact)]))
+
+    return {"first_stage_recall": recall(first_stage), "two_stage_recall": recall(rescored)}
@@ -0,0 +1,179 @@
+# fast_ir_evaluator.py (FAISS-backed retrieval metrics shared by training and index builds)
+
+import os
+import json
+import time
+import logging
+import numpy as np
+import faiss
+
+try:
+    # Subclassing lets model.fit() accept the evaluator; the index scorer works without it.
+    from sentence_transformers.evaluation import SentenceEvaluator as _EvaluatorBase
+except ImportError:
+    _EvaluatorBase = object
+
+# --- Configuration ---
+DEFAULT_K_VALUES = [1, 3, 5, 10]
+SEARCH_BLOCK_SIZE = 1024 # Queries searched per FAISS call (bounds the score buffer)
+
+# --- Held-out Query Set (shared format) ---
+def save_query_set(path, queries, relevant_docs):
+    """Writes {"queries": {qid: text}, "relevant_docs": {qid: [doc_id, ...]}} to JSON."""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({
+            "queries": queries,
+            "relevant_docs": {qid: sorted(str(d) for d in docs) for qid, docs in relevant_docs.items()}
+        }, f, ensure_ascii=False, indent=2)
+
+def load_query_set(path):
+    """Reads a query set written by save_query_set. Returns (queries, relevant_docs)."""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    relevant_docs = {qid: set(str(d) for d in docs) for qid, docs in data["relevant_docs"].items()}
+    return data["queries"], relevant_docs
+
+# --- Search and Metrics ---
+def blocked_search(index, query_embeddings, k, block_size=SEARCH_BLOCK_SIZE):
+    """Runs index.search in blocks of queries so memory stays flat for large query sets."""
+    all_scores, all_indices = [], []
+    for start in range(0, len(query_embeddings), block_size):
+        scores, indices = index.search(query_embeddings[start:start + block_size], k)
+        all_scores.append(scores)
+        all_indices.append(indices)
+    return np.vstack(all_scores), np.vstack(all_indices)
+
+def compute_metrics(ranked_doc_ids, query_ids, relevant_docs, k_values=DEFAULT_K_VALUES):
+    """Computes MRR@k, NDCG@k, recall@k and accuracy@k from ranked document id lists."""
+    metrics = {}
+    for k in k_values:
+        mrr, ndcg, recall, accuracy = 0.0, 0.0, 0.0, 0.0
+        for qid, ranked in zip(query_ids, ranked_doc_ids):
+            relevant = relevant_docs.get(qid, set())
+            if not relevant: continue
+            top = ranked[:k]
+            hits = [1 if doc_id in relevant else 0 for doc_id in top]
+            for rank, hit in enumerate(hits):
+                if hit:
+                    mrr += 1.0 / (rank + 1)
+                    break
+            dcg = sum(hit / np.log2(rank + 2) for rank, hit in enumerate(hits))
+            idcg = sum(1.0 / np.log2(rank + 2) for rank in range(min(len(relevant), k)))
+            ndcg += float(dcg / idcg)
+            recall += sum(hits) / len(relevant)
+            accuracy += 1.0 if any(hits) else 0.0
+        n = max(len(query_ids), 1)
+        metrics[f"mrr@{k}"] = mrr / n
+        metrics[f"ndcg@{k}"] = ndcg / n
+        metrics[f"recall@{k}"] = recall / n
+        metrics[f"accuracy@{k}"] = accuracy / n
+    return metrics
+
+def log_metrics(name, metrics, timings):
+    logging.info(f"[{name}] " + ", ".join(f"{key}: {value:.4f}" for key, value in metrics.items()))
+    logging.info(f"[{name}] Timing: " + ", ".join(f"{key}: {value:.2f}s" for key, value in timings.items()))
+
+# --- Model Evaluator (used during training) ---
+class FastRetrievalEvaluator(_EvaluatorBase):
+    """Drop-in replacement for InformationRetrievalEvaluator using a FAISS top-k search.
+
+    The corpus is encoded once per evaluation into an IndexFlatIP and queries are searched
+    in blocks, so no full query-by-corpus similarity matrix is ever materialized.
+    The returned main score is MRR@10 (or MRR at the largest k).
+    """
+
+    def __init__(self, queries, corpus, relevant_docs, name="", batch_size=128,
+                 k_values=DEFAULT_K_VALUES, show_progress_bar=False, write_csv=True):
+        super().__init__()
+        self.query_ids = list(queries.keys())
+        self.queries = [queries[qid] for qid in self.query_ids]
+        self.corpus_ids = list(corpus.keys())
+        self.corpus = [corpus[cid] for cid in self.corpus_ids]
+        self.relevant_docs = {qid: set(docs) for qid, docs in relevant_docs.items()}
+        self.name = name
+        self.batch_size = batch_size
+        self.k_values = sorted(k_values)
+        self.show_progress_bar = show_progress_bar
+        self.write_csv = write_csv
+        self.main_k = 10 if 10 in self.k_values else self.k_values[-1]
+        self.primary_metric = f"mrr@{self.main_k}"
+        self.last_timings = {}
+
+    def _encode(self, model, texts):
+        embeddings = model.encode(texts, batch_size=self.batch_size, convert_to_numpy=True,
+                                  normalize_embeddings=True, show_progress_bar=self.show_progress_bar)
+        return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+    def compute_metrics(self, model):
+        timings = {}
+        start = time.perf_counter()
+        corpus_embeddings = self._encode(model, self.corpus)
+        timings["encode_corpus"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        query_embeddings = self._encode(model, self.queries)
+        timings["encode_queries"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        corpus_index = faiss.IndexFlatIP(corpus_embeddings.shape[1])
+        corpus_index.add(corpus_embeddings)
+        _, indices = blocked_search(corpus_index, query_embeddings, min(self.k_values[-1], len(self.corpus_ids)))
+        timings["search"] = time.perf_counter() - start
+
+        ranked = [[self.corpus_ids[j] for j in row if j != -1] for row in indices]
+        metrics = compute_metrics(ranked, self.query_ids, self.relevant_docs, self.k_values)
+        self.last_timings = timings
+        return metrics
+
+    def __call__(self, model, output_path=None, epoch=-1, steps=-1):
+        start = time.perf_counter()
+        metrics = self.compute_metrics(model)
+        self.last_timings["total"] = time.perf_counter() - start
+        where = f"epoch {epoch}" + (f", steps {steps}" if steps != -1 else "")
+        logging.info(f"FastRetrievalEvaluator: evaluating {self.name} ({where})")
+        log_metrics(self.name, metrics, self.last_timings)
+
+        if output_path and self.write_csv:
+            os.makedirs(output_path, exist_ok=True)
+            csv_path = os.path.join(output_path, f"fast_ir_evaluation_{self.name}_results.csv")
+            write_header = not os.path.exists(csv_path)
+            with open(csv_path, 'a', encoding='utf-8') as f:
+                if write_header:
+                    f.write(",".join(["epoch", "steps"] + list(metrics.keys()) + ["eval_seconds"]) + "\n")
+                f.write(",".join([str(epoch), str(steps)] + [f"{v:.6f}" for v in metrics.values()]
+                                 + [f"{self.last_timings['total']:.3f}"]) + "\n")
+        return metrics[self.primary_metric]
+
+# --- Production Index Scoring (used by build_index.py) ---
+def evaluate_faiss_index(index, mapping, query_embeddings, query_ids, relevant_docs,
+                         k_values=DEFAULT_K_VALUES, chunk_oversample=5, name="production-index"):
+    """Scores a chunk-level FAISS index at the hadith level.
+
+    Chunk hits are expanded to all parent hadith ids sharing the vector and collapsed on
+    first occurrence, mirroring the parent-document handling done by /search. `mapping` is
+    the vector_index -> metadata dict written by build_index.py; `query_embeddings` must be
+    L2-normalized float32.
+    """
+    timings = {}
+    start = time.perf_counter()
+    max_k = k_values[-1]
+    _, indices = blocked_search(index, query_embeddings, min(max_k * chunk_oversample, index.ntotal))
+    timings["search"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ranked = []
+    for row in indices:
+        parents = []
+        for vector_idx in row:
+            if vector_idx == -1: continue
+            metadata = mapping.get(str(vector_idx)) or mapping.get(int(vector_idx))
+            if not metadata: continue
+            for parent_id in metadata.get("parent_hadith_ids") or [metadata.get("parent_hadith_id")]:
+                if str(parent_id) not in parents:
+                    parents.append(str(parent_id))
+            if len(parents) >= max_k: break
+        ranked.append(parents)
+    metrics = compute_metrics(ranked, query_ids, relevant_docs, k_values)
+    timings["metrics"] = time.perf_counter() - start
+    log_metrics(name, metrics, timings)
+    return metrics
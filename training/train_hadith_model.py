@@ -6,12 +6,16 @@ import json
 import random
 import numpy as np
 import re
-from torch.utils.data import DataLoader
-from sentence_transformers import SentenceTransformer, InputExample, LoggingHandler, util
+import time
+import hashlib
+from torch.utils.data import DataLoader, Dataset
+from sentence_transformers import SentenceTransformer, InputExample, LoggingHandler
 from sentence_transformers.losses import MultipleNegativesRankingLoss
-from sentence_transformers.evaluation import InformationRetrievalEvaluator, SimilarityFunction 
 from tqdm import tqdm
 import logging
+import faiss
+import sentence_transformers
+from fast_ir_evaluator import FastRetrievalEvaluator, save_query_set
 
 # --- Logging Setup ---
 logging.basicConfig(format='%(asctime)s - %(message)s',
@@ -23,6 +27,7 @@ logging.basicConfig(format='%(asctime)s - %(message)s',
 INPUT_JSON_PATH = "hadiths.json"
 OUTPUT_PATH = "hadith-semantic-model-labse" # Main output path (used by fit for tracking best score)
 CHECKPOINT_PATH = OUTPUT_PATH + "_checkpoints" # Store intermediate checkpoints separately
+EVAL_QUERIES_PATH = "eval_queries.json" # Held-out queries, also used by build_index.py to score the production index
 MODEL_NAME = 'sentence-transformers/LaBSE'
 TRAIN_SPLIT_RATIO = 0.9
 NUM_EPOCHS = 5
@@ -30,6 +35,15 @@ TRAIN_BATCH_SIZE = 64
 EVAL_BATCH_SIZE = 128
 LEARNING_RATE = 2e-5
 WARMUP_STEPS_RATIO = 0.1
+# Hard-negative mining (re-mined every epoch with the current model)
+MINE_HARD_NEGATIVES = True
+EMBEDDING_CACHE_DIR = "embedding_cache" # float16 base-model embeddings (fine-tuned ones are never reused, so not stored)
+RUN_ID = time.strftime('%Y%m%d-%H%M%S') # Names this run's epoch checkpoints
+MINING_TOP_K = 10 # Candidates retrieved per anchor before picking a negative
+MINING_MAX_SCORE_RATIO = 0.95 # Drop candidates scoring this close to the positive (likely false negatives)
+ENCODE_BATCH_SIZE = 256
+RANDOM_NEGATIVE_ATTEMPTS = 100 # Random draws before scanning for any text different from the anchor's
+TARGET_MRR_AT_10 = 0.92 # Stop early once the eval MRR@10 reaches this
 
 # --- Consistent Normalization Function ---
 def normalize_arabic_text(text):
@@ -42,6 +56,122 @@ def normalize_arabic_text(text):
     normalized = normalized.replace('ـ', '')
     return normalized.strip()
 
+# --- Embedding Cache (float16 on disk, keyed by model checkpoint) ---
+def embedding_cache_path(checkpoint_key, name):
+    """Returns the cache file for one corpus encoded by one checkpoint."""
+    safe_key = re.sub(r'[^A-Za-z0-9_.-]+', '_', checkpoint_key)
+    return os.path.join(EMBEDDING_CACHE_DIR, f"{safe_key}__{name}.npz")
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+def encode_with_cache(model, checkpoint_key, name, ids, texts, persist=True):
+    """Encodes texts with the model, reusing any embeddings already cached for this checkpoint.
+
+    `checkpoint_key` must identify the weights. Only pretrained weights are worth persisting
+    (`persist=True`): a fine-tuned epoch is encoded once per run and never seen again. Entries
+    are matched on id *and* a hash of the text, so edited texts are re-encoded.
+    Returns L2-normalized float32 embeddings in `ids` order.
+    """
+    path = embedding_cache_path(checkpoint_key, name)
+    hashes = [text_hash(t) for t in texts]
+    cached = {}
+    if persist and os.path.exists(path):
+        data = np.load(path)
+        if "text_hashes" in data.files: # Older cache files lack text hashes and are re-encoded
+            cached = {(doc_id, h): e for doc_id, h, e in zip(data["ids"].tolist(), data["text_hashes"].tolist(), data["embeddings"])}
+        logging.info(f"Loaded {len(cached)} cached '{name}' embeddings for {checkpoint_key}")
+
+    keys = list(zip(ids, hashes))
+    missing = [i for i, key in enumerate(keys) if key not in cached]
+    if missing:
+        logging.info(f"Encoding {len(missing)} '{name}' texts with {checkpoint_key}...")
+        new_embeddings = model.encode(
+            [texts[i] for i in missing], batch_size=ENCODE_BATCH_SIZE,
+            convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=True
+        )
+        for i, embedding in zip(missing, new_embeddings):
+            cached[keys[i]] = embedding.astype(np.float16)
+        if persist:
+            os.makedirs(EMBEDDING_CACHE_DIR, exist_ok=True)
+            np.savez(path, ids=np.array(ids), text_hashes=np.array(hashes),
+                     embeddings=np.stack([cached[key] for key in keys]).astype(np.float16))
+
+    embeddings = np.stack([cached[key] for key in keys]).astype(np.float32)
+    faiss.normalize_L2(embeddings) # float16 round trip slightly de-normalizes
+    return embeddings
+
+# --- Hard-Negative Mining ---
+def mine_hard_negative_examples(model, checkpoint_key, hadiths, persist_embeddings=True):
+    """Builds (arabic, english_positive, english_negative) triplets using a FAISS index.
+
+    Arabic anchors are searched against the English training corpus; the highest-ranked
+    English text that is not the positive (nor a near-copy of it) becomes the negative.
+    Anchors whose candidates are all filtered out get a random negative instead, so every
+    example is a triplet (MNRL batches cannot mix pairs and triplets).
+    """
+    ids = [str(h["id"]) for h in hadiths]
+    anchor_embeddings = encode_with_cache(model, checkpoint_key, "arabic", ids, [h["normalized_arabic"] for h in hadiths],
+                                          persist=persist_embeddings)
+    corpus_embeddings = encode_with_cache(model, checkpoint_key, "english", ids, [h["english_text"] for h in hadiths],
+                                          persist=persist_embeddings)
+
+    corpus_index = faiss.IndexFlatIP(corpus_embeddings.shape[1])
+    corpus_index.add(corpus_embeddings)
+    scores, neighbors = corpus_index.search(anchor_embeddings, MINING_TOP_K + 1)
+    positive_scores = np.einsum('ij,ij->i', anchor_embeddings, corpus_embeddings)
+
+    rng = random.Random(42)
+    examples, num_random = [], 0
+    for i, hadith in enumerate(hadiths):
+        negative = None
+        for score, j in zip(scores[i], neighbors[i]):
+            if j == -1 or j == i: continue
+            if score > positive_scores[i] * MINING_MAX_SCORE_RATIO: continue
+            if hadiths[j]["english_text"] == hadith["english_text"]: continue # Parallel narration, not a negative
+            negative = hadiths[j]["english_text"]
+            break
+        if negative is None:
+            negative = random_negative(hadiths, hadith["english_text"], rng)
+            num_random += 1
+        examples.append(InputExample(texts=[hadith["normalized_arabic"], hadith["english_text"], negative]))
+    logging.info(f"Mined hard negatives for {len(examples) - num_random}/{len(examples)} training pairs "
+                 f"({num_random} random fallbacks, {checkpoint_key}).")
+    return examples
+
+def random_negative(hadiths, positive_text, rng):
+    """A random English text different from the positive; raises if the corpus has no such text."""
+    for _ in range(RANDOM_NEGATIVE_ATTEMPTS):
+        text = hadiths[rng.randrange(len(hadiths))]["english_text"]
+        if text != positive_text:
+            return text
+    others = [h["english_text"] for h in hadiths if h["english_text"] != positive_text]
+    if not others:
+        raise ValueError("Every training hadith has the same English text; no negative can be drawn.")
+    return rng.choice(others)
+
+class RefreshableExamples(Dataset):
+    """Training examples that can be swapped between epochs without rebuilding the DataLoader.
+
+    The legacy fit() loop re-iterates the same DataLoader every epoch, so replacing the examples
+    from the epoch-end callback feeds freshly mined triplets into the next epoch while the
+    optimizer and learning-rate schedule carry on. The length must not change.
+    """
+
+    def __init__(self, examples):
+        self.examples = examples
+
+    def refresh(self, examples):
+        if len(examples) != len(self.examples):
+            raise ValueError(f"Refreshed dataset has {len(examples)} examples, expected {len(self.examples)}")
+        self.examples = examples
+
+    def __len__(self):
+        return len(self.examples)
+
+    def __getitem__(self, i):
+        return self.examples[i]
+
 # --- Load and Prepare Data ---
 logging.info(f"Loading data from {INPUT_JSON_PATH}...")
 # ... (rest of data loading and prep is identical to the previous training script version) ...
@@ -66,13 +196,9 @@ eval_h = valid_hadiths[split_idx:]
 logging.info(f"Train set size: {len(train_h)}, Evaluation set size: {len(eval_h)}")
 
 # --- Prepare Data for Training ---
-train_examples = []
-for hadith in train_h:
-    if hadith.get("normalized_arabic") and hadith.get("english_text"):
-         train_examples.append(InputExample(texts=[hadith["normalized_arabic"], hadith["english_text"]]))
-    else:
-        logging.warning(f"Skipping hadith ID {hadith.get('id')} due to missing text.")
-logging.info(f"Created {len(train_examples)} training examples for MNRL.")
+train_h = [h for h in train_h if h.get("normalized_arabic") and h.get("english_text")]
+train_examples = [InputExample(texts=[h["normalized_arabic"], h["english_text"]]) for h in train_h]
+logging.info(f"Created {len(train_examples)} training pairs for MNRL.")
 
 # --- Prepare Data for Evaluation ---
 eval_queries = {} 
@@ -97,49 +223,84 @@ logging.info(f"Evaluation: {len(eval_queries)} queries, {len(eval_corpus)} corpu
 if len(eval_queries) != len(eval_corpus) or len(eval_queries) != len(eval_relevant_docs):
      logging.error("Mismatch in evaluation data sizes!"); exit()
 
+# Export the held-out split keyed by hadith id so the production index is judged on the same queries
+save_query_set(
+    EVAL_QUERIES_PATH,
+    {f"q_{i}": h["normalized_arabic"] for i, h in enumerate(eval_h) if h.get("normalized_arabic") and h.get("english_text")},
+    {f"q_{i}": {str(h["id"])} for i, h in enumerate(eval_h) if h.get("normalized_arabic") and h.get("english_text")}
+)
+logging.info(f"Held-out query set written to {EVAL_QUERIES_PATH}")
+
 # --- Initialize Model ---
 logging.info(f"Loading base model: {MODEL_NAME}")
 model = SentenceTransformer(MODEL_NAME)
 
-# --- Prepare DataLoader and Loss ---
-train_dataloader = DataLoader(train_examples, shuffle=True, batch_size=TRAIN_BATCH_SIZE)
+# --- Loss ---
 train_loss = MultipleNegativesRankingLoss(model=model)
 
 # --- Prepare Evaluator ---
-evaluator = InformationRetrievalEvaluator(
+# FAISS top-k search instead of a full query-by-corpus cos_sim matrix; returns MRR@10
+evaluator = FastRetrievalEvaluator(
     queries=eval_queries, corpus=eval_corpus, relevant_docs=eval_relevant_docs,
-    batch_size=EVAL_BATCH_SIZE, main_score_function=SimilarityFunction.COSINE, 
-    score_functions={'cos_sim': util.cos_sim}, name='hadith-retrieval-eval',
-    show_progress_bar=True, mrr_at_k=[10], ndcg_at_k=[10], 
-    accuracy_at_k=[1, 3, 5, 10], precision_recall_at_k=[1, 3, 5, 10], map_at_k=[10]
+    batch_size=EVAL_BATCH_SIZE, name='hadith-retrieval-eval',
+    k_values=[1, 3, 5, 10], show_progress_bar=True
 )
 
+# --- Training Data (hard negatives mined with the base model for epoch 1) ---
+if MINE_HARD_NEGATIVES:
+    if int(sentence_transformers.__version__.split(".")[0]) >= 3:
+        # v3's fit() converts the dataset once up front, so later refreshes would be ignored
+        logging.warning("sentence-transformers >= 3: negatives are mined once with the base model, not re-mined per epoch.")
+    train_dataset = RefreshableExamples(mine_hard_negative_examples(model, MODEL_NAME, train_h))
+else:
+    train_dataset = RefreshableExamples(train_examples)
+train_dataloader = DataLoader(train_dataset, shuffle=True, batch_size=TRAIN_BATCH_SIZE)
+
 # --- Calculate Warmup Steps ---
 num_training_steps = len(train_dataloader) * NUM_EPOCHS
 warmup_steps = int(num_training_steps * WARMUP_STEPS_RATIO)
 logging.info(f"Total training steps: {num_training_steps}, Warmup steps: {warmup_steps}")
 
+# --- Epoch-end Callback: checkpoint, track the best model, re-mine negatives ---
+class TargetReached(Exception):
+    pass
+
+best_score = -1.0
+
+def on_epoch_end(score, epoch, steps):
+    """Called by fit() after the evaluator at the end of every epoch."""
+    global best_score
+    checkpoint_key = f"{RUN_ID}-epoch-{epoch + 1}"
+    epoch_checkpoint_path = os.path.join(CHECKPOINT_PATH, checkpoint_key)
+    model.save(epoch_checkpoint_path)
+    logging.info(f"Epoch {epoch + 1}/{NUM_EPOCHS}: MRR@10 = {score:.4f} (checkpoint: {epoch_checkpoint_path})")
+    if score > best_score:
+        best_score = score
+        model.save(OUTPUT_PATH)
+        logging.info(f"New best model saved to {OUTPUT_PATH}")
+    if best_score >= TARGET_MRR_AT_10:
+        raise TargetReached(f"Reached target MRR@10 of {TARGET_MRR_AT_10} after {epoch + 1} epochs")
+    if MINE_HARD_NEGATIVES and epoch + 1 < NUM_EPOCHS:
+        # Negatives get harder as the model improves; the next epoch iterates the refreshed examples
+        train_dataset.refresh(mine_hard_negative_examples(model, checkpoint_key, train_h, persist_embeddings=False))
+
 # --- Train the Model ---
+# A single fit() call keeps one AdamW optimizer and the baseline warmup + linear-decay schedule
+# across all epochs; only the triplets change between epochs.
 logging.info("Starting model training...")
-# model.fit saves the best model checkpoint based on evaluator to CHECKPOINT_PATH
-# It also uses OUTPUT_PATH internally to track the best score and save the final state (which seemed problematic)
-# We will ignore the final state in OUTPUT_PATH and load directly from the best checkpoint saved in CHECKPOINT_PATH
-model.fit(train_objectives=[(train_dataloader, train_loss)],
-          evaluator=evaluator,
-          epochs=NUM_EPOCHS,
-          evaluation_steps=int(len(train_dataloader) * 0.5), 
-          warmup_steps=warmup_steps,
-          optimizer_params={'lr': LEARNING_RATE},
-          output_path=OUTPUT_PATH, # Still needed for tracking best score
-          save_best_model=True,    # Saves best checkpoint to CHECKPOINT_PATH/checkpoint-<step>
-          checkpoint_save_steps=int(len(train_dataloader) * 0.5),
-          checkpoint_path=CHECKPOINT_PATH, # Explicit path for checkpoints
-          use_amp=True 
-          )
-logging.info("Training finished.")
-logging.info(f"Checkpoints saved in: {CHECKPOINT_PATH}")
-logging.info(f"Best checkpoint should be Step 2367 based on previous logs (MRR@10: ~0.9198)") 
-
-# Removed the explicit load/save block as it was causing errors
+try:
+    model.fit(train_objectives=[(train_dataloader, train_loss)],
+              evaluator=evaluator,
+              epochs=NUM_EPOCHS,
+              warmup_steps=warmup_steps,
+              optimizer_params={'lr': LEARNING_RATE},
+              callback=on_epoch_end,
+              save_best_model=False, # on_epoch_end saves the best model (it may stop the run first)
+              use_amp=True 
+              )
+except TargetReached as e:
+    logging.info(f"{e}, stopping early.")
 
-print(f"Training process complete. Best model checkpoint is likely in {CHECKPOINT_PATH}/checkpoint-2367")
\ No newline at end of file
+logging.info("Training finished.")
+logging.info(f"Per-epoch checkpoints saved in: {CHECKPOINT_PATH}")
+print(f"Training process complete. Best model (MRR@10: {best_score:.4f}) saved in {OUTPUT_PATH}")